@@ -4,9 +4,14 @@ import multiprocessing
 
 # Configuración básica
 bind = f"{os.getenv('WEBHOOK_HOST', '0.0.0.0')}:{os.getenv('WEBHOOK_PORT', '8000')}"
-workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
-threads = int(os.getenv('GUNICORN_THREADS', '2'))
+# Un worker por núcleo: cada UvicornWorker ejecuta su propio event loop asíncrono
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+# UvicornWorker no utiliza threads; se deja en 1 para no sobredimensionar
+threads = 1
 timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+# UvicornWorker usa loop="auto" y http="auto", que seleccionan uvloop y httptools
+# automáticamente cuando están instalados (uvicorn[standard])
 worker_class = 'uvicorn.workers.UvicornWorker'
 
 # Configuración de logs
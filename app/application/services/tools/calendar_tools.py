@@ -5,28 +5,74 @@ Este módulo contiene funciones para obtener slots disponibles y gestionar reser
 #Debería de estar en la capa de data/services/repository ⚠️
 
 import json
+import heapq
+import logging
 import aiohttp
+import ciso8601
+import orjson
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import Dict, List, Optional, Union, Any, Tuple, TypedDict, Callable
 from functools import wraps
 
+from fastapi import HTTPException
+
 from app.domain.entities.models import (
     AvailableSlot, SlotsResult, ErrorResult, BookingResult
 )
 from app.application.services.tools.date_utils import (
     get_timezone_instance, parse_natural_date, 
-    format_time_slots, create_readable_slots, format_date_human_readable
+    create_readable_slots, format_date_human_readable
 )
 from app.infrastructure.config.config.settings import TimeZones, DEFAULT_TIMEZONE, get_settings
 
+logger = logging.getLogger(__name__)
+
+# Endpoints de la API de Cal.com
+_CALCOM_SLOTS_URL = "https://api.cal.com/v1/slots"
+_CALCOM_BOOKINGS_URL = "https://api.cal.com/v1/bookings"
+
+# Límites de slots a mostrar al usuario
+MAX_SLOT_DAYS = 3
+MAX_SLOTS_PER_DAY = 3
+
+# Sesión HTTP compartida para reutilizar conexiones (keep-alive y pool de conexiones)
+_session: Optional[aiohttp.ClientSession] = None
+
+async def _get_session() -> aiohttp.ClientSession:
+    """
+    Obtiene la sesión HTTP compartida, creándola de forma perezosa.
+    
+    Returns:
+        Sesión de aiohttp reutilizada entre solicitudes
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return _session
+
+async def close_session() -> None:
+    """Cierra la sesión HTTP compartida si está abierta."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
 # Decorador para manejo de errores en herramientas
 def handle_tool_errors(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         try:
             return await func(*args, **kwargs)
+        except HTTPException:
+            # Las excepciones HTTP deben llegar al framework con su código de estado
+            # (asyncio.CancelledError hereda de BaseException y tampoco se captura aquí)
+            raise
         except Exception as e:
+            logger.exception("Error en la herramienta %s", func.__name__)
             return {
                 "error": f"Error en la operación: {str(e)}",
                 "details": f"Ocurrió un error inesperado en {func.__name__}"
@@ -53,25 +99,18 @@ async def api_request(
     Returns:
         Tupla con (código_respuesta, datos_json)
     """
-    async with aiohttp.ClientSession() as session:
-        method_func = getattr(session, method.lower())
-        
-        kwargs = {}
-        if params:
-            kwargs['params'] = params
-        if headers:
-            kwargs['headers'] = headers
-        if data:
-            kwargs['data'] = json.dumps(data)
+    session = await _get_session()
+    
+    async with session.request(method.upper(), url, params=params, headers=headers, json=data) as response:
+        try:
+            # content_type=None evita fallar cuando el servidor etiqueta mal el JSON;
+            # orjson decodifica en C las respuestas grandes de slots
+            response_data = await response.json(loads=orjson.loads, content_type=None)
+        except (aiohttp.ContentTypeError, ValueError):
+            response_text = await response.text()
+            response_data = {"text": response_text}
             
-        async with method_func(url, **kwargs) as response:
-            try:
-                response_data = await response.json()
-            except:
-                response_text = await response.text()
-                response_data = {"text": response_text}
-                
-            return response.status, response_data
+        return response.status, response_data
 
 @handle_tool_errors
 async def get_slots(date_expression: str = None) -> Union[SlotsResult, ErrorResult]:
@@ -109,76 +148,81 @@ async def get_slots(date_expression: str = None) -> Union[SlotsResult, ErrorResu
     # Interpretar expresión de fecha en lenguaje natural
     start_time, end_time = parse_natural_date(date_expression, today, mexico_tz)
     
+    # Solo se necesita la parte Y-M-D; se formatea una vez sin pasar por strftime
+    date_from = f"{start_time.year:04d}-{start_time.month:02d}-{start_time.day:02d}"
+    date_to = f"{end_time.year:04d}-{end_time.month:02d}-{end_time.day:02d}"
+    
     # Configurar parámetros para la API
-    url = "https://api.cal.com/v1/slots"
     params = {
         "apiKey": api_key,
         "eventTypeId": event_type_id,
-        "startTime": start_time.strftime("%Y-%m-%d"),
-        "endTime": end_time.strftime("%Y-%m-%d"),
+        "startTime": date_from,
+        "endTime": date_to,
         "timeZone": settings["timezone"]["default"]
     }
 
     # Realizar solicitud a la API
-    status_code, data = await api_request("get", url, params=params)
+    status_code, data = await api_request("get", _CALCOM_SLOTS_URL, params=params)
     
     if status_code != 200:
         error_details = data.get("text", str(data)) if isinstance(data, dict) else str(data)
         return {"error": f"Error al obtener disponibilidad: {status_code}", "details": error_details}
     
-    # Procesar los slots disponibles
-    available_slots = []
-    slots_by_date = {}
+    # Procesar los slots disponibles directamente en una lista plana (sin agrupar por fecha)
+    formatted_slots = []
+    days_with_slots = 0
                     
-    # Extraer y procesar todos los slots disponibles
-    for day, slots in data.get("slots", {}).items():
-        day_slots = []
+    # Extraer los slots en orden de fecha, deteniéndose al alcanzar los límites de la respuesta.
+    # Las fechas salen de un heap según se necesitan, sin ordenar todo el rango consultado
+    # (son únicas, así que las tuplas se comparan solo por la fecha)
+    days_heap = list(data.get("slots", {}).items())
+    heapq.heapify(days_heap)
+    while days_heap:
+        day, slots = heapq.heappop(days_heap)
+        day_slot_count = 0
+        readable_date = None
         for slot in slots:
             time_str = slot.get("time")
             if not time_str:
                 continue
                 
-            # Convertir la hora a un formato estándar
+            # Convertir la hora a un formato estándar (ciso8601 acepta 'Z' y offsets +HH:MM)
             try:
-                # Intentar diferentes formatos de hora
-                if '+' in time_str or '-' in time_str:
-                    time_dt = datetime.fromisoformat(time_str)
-                else:
-                    time_dt = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+                time_dt = ciso8601.parse_datetime(time_str)
             except ValueError:
-                try:
-                    # Último intento con formato simple
-                    date_part = day
-                    time_part = time_str.split('T')[1] if 'T' in time_str else time_str
-                    time_dt = datetime.strptime(f"{date_part} {time_part.split('+')[0].split('-')[0]}", "%Y-%m-%d %H:%M:%S")
-                except:
-                    # Si falla, omitimos este slot
-                    continue
+                # Si falla, omitimos este slot
+                continue
+            
+            # La fecha legible se calcula una sola vez por día
+            if readable_date is None:
+                readable_date = format_date_human_readable(time_dt)
             
             # Añadir slot procesado
-            slot_info = {
+            formatted_slots.append({
                 "date": day,
                 "start_time": time_dt.strftime("%H:%M"),
                 "iso_time": time_str,
-                "formatted": time_dt.strftime("%H:%M")
-            }
+                "formatted": time_dt.strftime("%H:%M"),
+                "readable_date": readable_date
+            })
             
-            day_slots.append(slot_info)
+            day_slot_count += 1
+            if day_slot_count >= MAX_SLOTS_PER_DAY:
+                break
         
-        # Si hay slots para este día, los añadimos al diccionario
-        if day_slots:
-            slots_by_date[day] = day_slots
-    
-    # Formatear y limitar los slots
-    formatted_slots = format_time_slots(slots_by_date)
+        # Contar el día solo si aportó slots
+        if day_slot_count:
+            days_with_slots += 1
+            if days_with_slots >= MAX_SLOT_DAYS:
+                break
     
     # Si no hay slots disponibles después del procesamiento
     if not formatted_slots:
         return {
             "error": "No hay disponibilidad para las fechas seleccionadas.",
             "date_query": date_expression if date_expression else "próximos días",
-            "date_from": start_time.strftime("%Y-%m-%d"),
-            "date_to": end_time.strftime("%Y-%m-%d")
+            "date_from": date_from,
+            "date_to": date_to
         }
     
     # Crear slots legibles para el usuario
@@ -190,8 +234,8 @@ async def get_slots(date_expression: str = None) -> Union[SlotsResult, ErrorResu
         "readable_slots": readable_slots,
         "total_slots": len(formatted_slots),
         "date_query": date_expression if date_expression else "próximos días",
-        "date_from": start_time.strftime("%Y-%m-%d"),
-        "date_to": end_time.strftime("%Y-%m-%d")
+        "date_from": date_from,
+        "date_to": date_to
     }
 
 @handle_tool_errors
@@ -256,8 +300,11 @@ async def schedule_appointment(
         mexico_tz = get_timezone_instance(TimeZones.MEXICO)
         
         # Crear objeto datetime para la hora de inicio con zona horaria de México
-        naive_dt = datetime.strptime(f"{selected_date}T{selected_time}", "%Y-%m-%dT%H:%M")
-        mexico_dt = mexico_tz.localize(naive_dt)
+        # (formato fijo YYYY-MM-DD y HH:MM, se parsea directamente sin strptime)
+        year, month, day = (int(part) for part in selected_date.split('-'))
+        hour, minute = (int(part) for part in selected_time.split(':'))
+        naive_dt = datetime(year, month, day, hour, minute)
+        mexico_dt = naive_dt.replace(tzinfo=mexico_tz)
         
         # Verificar que la fecha está en el futuro
         now = datetime.now(mexico_tz)
@@ -276,10 +323,6 @@ async def schedule_appointment(
     except ValueError:
         return {"error": "Formato de fecha u hora inválido. Use YYYY-MM-DD para fecha y HH:MM para hora."}
     
-    # Configurar la solicitud para la API
-    booking_url = f"https://api.cal.com/v1/bookings?apiKey={api_key}"
-    headers = {"Content-Type": "application/json"}
-    
     # Configurar payload según la estructura esperada por la API
     payload = {
         "eventTypeId": int(event_type_id),
@@ -301,19 +344,19 @@ async def schedule_appointment(
     }
     
     # Realizar la solicitud a la API
-    status_code, booking_data = await api_request("post", booking_url, headers=headers, data=payload)
+    status_code, booking_data = await api_request("post", _CALCOM_BOOKINGS_URL, params={"apiKey": api_key}, data=payload)
     
     # Procesar la respuesta
     if status_code in (200, 201):
         # Asegurar que booking_data es un diccionario
         if not isinstance(booking_data, dict):
             try:
-                booking_data = json.loads(booking_data)
-            except:
+                booking_data = orjson.loads(booking_data)
+            except orjson.JSONDecodeError:
                 booking_data = {"message": "Reserva exitosa pero respuesta no procesable"}
         
         # Formatear la fecha para mostrarla de forma amigable
-        date_obj = datetime.strptime(selected_date, "%Y-%m-%d")
+        date_obj = date(year, month, day)
         formatted_date = format_date_human_readable(date_obj)
         
         # ID de la reserva
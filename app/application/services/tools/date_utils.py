@@ -11,14 +11,29 @@ Este módulo contiene funciones para el manejo de fechas, conversiones, y format
 #Python internacionalization library: pytz, babel, etc. 📚
 
 import re
-import pytz
 import calendar
 from datetime import datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 from dateutil.relativedelta import relativedelta
 from typing import Tuple, Optional
 from app.infrastructure.config.config.settings import TimeZones, TIMEZONE_MAP, DEFAULT_TIMEZONE
 
-def get_timezone_instance(tz: TimeZones = DEFAULT_TIMEZONE) -> pytz.timezone:
+# Patrones precompilados para interpretar fechas en lenguaje natural
+_WEEKDAY_RE = re.compile(r'\b(lunes|martes|mi[eé]rcoles|jueves|viernes|s[aá]bado|domingo)\b')
+_SPANISH_DATE_RE = re.compile(
+    r'(\d+)\s+de\s+(enero|febrero|marzo|abril|mayo|junio|julio|agosto|'
+    r'septiembre|octubre|noviembre|diciembre)\b'
+)
+_ISO_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+# Nombres de días y meses en español (índice 0 = Lunes; índice 0 de meses vacío)
+_DAY_NAMES = ("Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo")
+_MONTH_NAMES = ("", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+                "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre")
+
+@lru_cache(maxsize=8)
+def get_timezone_instance(tz: TimeZones = DEFAULT_TIMEZONE) -> ZoneInfo:
     """
     Obtiene la instancia de zona horaria basada en la enumeración.
     
@@ -26,9 +41,9 @@ def get_timezone_instance(tz: TimeZones = DEFAULT_TIMEZONE) -> pytz.timezone:
         tz: La zona horaria a utilizar (de la enumeración TimeZones)
         
     Returns:
-        Instancia de pytz.timezone para la zona horaria solicitada
+        Instancia de ZoneInfo (en caché) para la zona horaria solicitada
     """
-    return pytz.timezone(TIMEZONE_MAP[tz])
+    return ZoneInfo(TIMEZONE_MAP[tz])
 
 def format_date_human_readable(date_obj: datetime, include_year: bool = True) -> str:
     """
@@ -41,22 +56,31 @@ def format_date_human_readable(date_obj: datetime, include_year: bool = True) ->
     Returns:
         Cadena formateada con la fecha en español
     """
-    day_names = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
-    month_names = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", 
-                    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-    
-    day_name = day_names[date_obj.weekday()]
+    day_name = _DAY_NAMES[date_obj.weekday()]
     day = date_obj.day
-    month = month_names[date_obj.month]
+    month = _MONTH_NAMES[date_obj.month]
     
     if include_year:
         return f"{day_name} {day} de {month} de {date_obj.year}"
     return f"{day_name} {day} de {month}"
 
+@lru_cache(maxsize=64)
+def _format_iso_date_human_readable(date_str: str) -> str:
+    """
+    Formatea una fecha YYYY-MM-DD en español, memorizando el resultado por fecha.
+    
+    Args:
+        date_str: Fecha en formato YYYY-MM-DD
+        
+    Returns:
+        Cadena formateada con la fecha en español
+    """
+    return format_date_human_readable(datetime.strptime(date_str, '%Y-%m-%d'))
+
 def parse_natural_date(
     date_expression: Optional[str], 
     today: datetime, 
-    tz: pytz.timezone
+    tz: ZoneInfo
 ) -> Tuple[datetime, datetime]:
     """
     Interpreta una expresión de fecha en lenguaje natural.
@@ -99,48 +123,40 @@ def parse_natural_date(
         start_time = today + timedelta(days=2)
     
     # Caso 2: Próximo día de la semana (ej. "lunes próximo")
-    elif any(dia in date_expression for dia in dias.keys()):
-        # Encontrar qué día de la semana se mencionó
-        dia_mencionado = next((dia for dia in dias.keys() if dia in date_expression), None)
-        
-        if dia_mencionado:
-            dia_objetivo = dias[dia_mencionado]
-            dias_para_sumar = (dia_objetivo - today.weekday()) % 7
-            if dias_para_sumar == 0:  # Si es hoy, vamos a la próxima semana
-                dias_para_sumar = 7
-            start_time = today + timedelta(days=dias_para_sumar)
+    elif (match := _WEEKDAY_RE.search(date_expression)):
+        dia_objetivo = dias[match.group(1)]
+        dias_para_sumar = (dia_objetivo - today.weekday()) % 7
+        if dias_para_sumar == 0:  # Si es hoy, vamos a la próxima semana
+            dias_para_sumar = 7
+        start_time = today + timedelta(days=dias_para_sumar)
     
     # Caso 3: Fecha específica (ej. "31 de marzo")
-    elif re.search(r'(\d+)\s+de\s+(\w+)', date_expression):
-        match = re.search(r'(\d+)\s+de\s+(\w+)', date_expression)
+    elif (match := _SPANISH_DATE_RE.search(date_expression)):
         dia = int(match.group(1))
-        mes_str = match.group(2).lower()
+        mes = meses[match.group(2)]
+        
+        # Determinar el año (este año o el próximo)
+        anio = today.year
+        # Si la fecha ya pasó este año, usamos el próximo año
+        if mes < today.month or (mes == today.month and dia < today.day):
+            anio += 1
         
-        if mes_str in meses:
-            mes = meses[mes_str]
-            
-            # Determinar el año (este año o el próximo)
-            anio = today.year
-            # Si la fecha ya pasó este año, usamos el próximo año
-            if mes < today.month or (mes == today.month and dia < today.day):
-                anio += 1
-            
-            # Validar que la fecha sea válida
-            try:
-                dias_en_mes = calendar.monthrange(anio, mes)[1]
-                if 1 <= dia <= dias_en_mes:
-                    # Crear datetime sin timezone y luego localizarlo
-                    naive_dt = datetime(anio, mes, dia)
-                    start_time = tz.localize(naive_dt)
-            except ValueError:
-                pass  # Si hay error, mantenemos el valor predeterminado
+        # Validar que la fecha sea válida
+        try:
+            dias_en_mes = calendar.monthrange(anio, mes)[1]
+            if 1 <= dia <= dias_en_mes:
+                # Crear datetime sin timezone y luego asignarle la zona horaria
+                naive_dt = datetime(anio, mes, dia)
+                start_time = naive_dt.replace(tzinfo=tz)
+        except ValueError:
+            pass  # Si hay error, mantenemos el valor predeterminado
     
     # Caso 4: Fecha con formato estándar (YYYY-MM-DD)
-    elif re.match(r'^\d{4}-\d{2}-\d{2}$', date_expression):
+    elif _ISO_DATE_RE.match(date_expression):
         try:
-            # Crear datetime sin timezone y luego localizarlo
+            # Crear datetime sin timezone y luego asignarle la zona horaria
             naive_dt = datetime.strptime(date_expression, "%Y-%m-%d")
-            start_time = tz.localize(naive_dt)
+            start_time = naive_dt.replace(tzinfo=tz)
         except ValueError:
             pass  # Si hay error, mantenemos el valor predeterminado
     
@@ -155,31 +171,6 @@ def parse_natural_date(
         
     return start_time, end_time
 
-def format_time_slots(
-    slots_by_date: dict, 
-    max_days: int = 3,
-    max_slots_per_day: int = 3
-) -> list:
-    """
-    Formatea y limita los slots disponibles.
-    
-    Args:
-        slots_by_date: Diccionario de slots agrupados por fecha
-        max_days: Número máximo de días a incluir
-        max_slots_per_day: Número máximo de slots por día
-        
-    Returns:
-        Lista de slots formateados y limitados
-    """
-    formatted_slots = []
-    
-    # Tomar hasta max_days días con hasta max_slots_per_day slots cada uno
-    for date, slots in sorted(slots_by_date.items())[:max_days]:
-        formatted_slots.extend(slots[:max_slots_per_day])
-    
-    # Limitar al máximo total (max_days * max_slots_per_day)
-    return formatted_slots[:max_days * max_slots_per_day]
-
 def create_readable_slots(formatted_slots: list, emoji: str = "🕓") -> list:
     """
     Crea representaciones legibles de los slots disponibles.
@@ -191,8 +182,9 @@ def create_readable_slots(formatted_slots: list, emoji: str = "🕓") -> list:
     Returns:
         Lista de cadenas legibles con formato atractivo
     """
+    # Se usa la fecha legible precalculada por get_slots; si falta, se formatea una vez por fecha
     return [
-        f"{emoji} *Opción {i+1}:* {format_date_human_readable(datetime.strptime(slot['date'], '%Y-%m-%d'))} "
+        f"{emoji} *Opción {i+1}:* {slot.get('readable_date') or _format_iso_date_human_readable(slot['date'])} "
         f"a las *{slot['start_time']}* hrs"
         for i, slot in enumerate(formatted_slots)
     ] 
\ No newline at end of file
@@ -11,6 +11,7 @@ class AvailableSlot(TypedDict):
     start_time: str
     iso_time: str
     formatted: str
+    readable_date: str
 
 class SlotsResult(TypedDict):
     """Modelo para representar el resultado de una búsqueda de slots disponibles"""
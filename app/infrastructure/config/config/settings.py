@@ -3,10 +3,10 @@ Configuración centralizada del proyecto.
 Este módulo gestiona todas las variables de configuración y entorno.
 """
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from typing import Dict, Any, Optional
 from enum import Enum, auto
-import pytz
 
 # Carga explícita del archivo .env
 load_dotenv(verbose=True)
@@ -35,14 +35,24 @@ CALCOM_USEREMAIL = os.getenv("CALCOM_USEREMAIL")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
+# Configuración de Redis (rate limiting compartido entre workers; opcional)
+REDIS_URL = os.getenv("REDIS_URL")
+
 # Configuración del Webhook
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "mi_clave_secreta_para_webhook")
 WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8000"))
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
 
+# Tiempo máximo (segundos) de una ejecución del agente; incluye el modelo y las llamadas
+# a herramientas (consulta y reserva en Cal.com), así que debe ser menor que
+# GUNICORN_TIMEOUT y que el límite de 60 s de Cloud Run
+AGENT_TIMEOUT = int(os.getenv("AGENT_TIMEOUT", "45"))
+
 # Función para obtener la configuración como diccionario
+# Los valores se leen una sola vez al importar el módulo, por lo que el diccionario se puede reutilizar
+@lru_cache(maxsize=1)
 def get_settings() -> Dict[str, Any]:
-    """Retorna la configuración actual como un diccionario."""
+    """Retorna la configuración actual como un diccionario (construido una sola vez)."""
     return {
         "calcom": {
             "api_key": CALCOM_API_KEY,
@@ -3,14 +3,135 @@ Agente principal de turismo.
 Este módulo define la configuración y funcionalidad del agente conversacional de turismo.
 """
 import asyncio
+import logging
 import uuid
-import re
+import re2
 from datetime import datetime, timezone
-from typing import List, Dict, Optional, Any, Union
+from typing import Awaitable, Callable, List, Dict, Optional, Any, Set, Union
 from agents import Agent, Runner
+from cachetools import TTLCache
 
 from app.application.services.tools.calendar_tools import get_slots, schedule_appointment
-from app.services.supabase_service import supabase_service
+from app.services.supabase_service import get_supabase_service
+from app.infrastructure.config.config.settings import AGENT_TIMEOUT
+
+# Patrones precompilados para extraer datos persistentes del usuario, uno por campo:
+# cada campo se busca de forma independiente para que la coincidencia de uno (p. ej. el
+# nombre) no consuma el texto de otro (el email que le sigue).
+# RE2 garantiza tiempo lineal y evita backtracking con mensajes arbitrarios
+_NAME_RE = re2.compile(r"(?i)(?:me\s+llamo|soy|nombre\s+es)\s+([A-Za-zÀ-ÿ]+(?:\s[A-Za-zÀ-ÿ]+){0,3})")
+_EMAIL_RE = re2.compile(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")
+_PHONE_RE = re2.compile(r"(?:\+\d{1,3}[\s-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}")
+
+def _extract_user_data(message: str) -> Dict[str, str]:
+    """
+    Extrae nombre, email y teléfono de un mensaje (primera coincidencia de cada campo).
+    
+    Args:
+        message: Mensaje del usuario
+        
+    Returns:
+        Diccionario con los campos detectados
+    """
+    detected: Dict[str, str] = {}
+    # Inicio de cada email/teléfono: el nombre no puede extenderse sobre ellos
+    # (en "soy Ana ana@x.com" la última palabra del nombre es el inicio del email)
+    boundaries = []
+    for key, pattern in (("email", _EMAIL_RE), ("phone", _PHONE_RE)):
+        match = pattern.search(message)
+        if match:
+            detected[key] = match.group(0)
+            boundaries.append(match.start())
+    
+    name_match = _NAME_RE.search(message)
+    if name_match:
+        start, end = name_match.span(1)
+        end = min([end] + [b for b in boundaries if start <= b < end])
+        name = message[start:end].strip()
+        if name:
+            detected["name"] = name
+    return detected
+
+logger = logging.getLogger(__name__)
+
+# Tareas de persistencia en curso (se guardan referencias para que el GC no las descarte)
+_background_tasks: Set[asyncio.Task] = set()
+
+# Máximo de escrituras de persistencia simultáneas hacia Supabase; el resto espera su turno
+MAX_PENDING_WRITES = 256
+_background_semaphore: Optional[asyncio.Semaphore] = None
+
+# Máximo de escrituras pendientes (en curso o en espera); por encima se descartan
+MAX_BACKGROUND_TASKS = 4096
+
+def _on_background_task_done(task: asyncio.Task) -> None:
+    """Libera la referencia de la tarea y registra su error, si lo hubo."""
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Error en tarea de persistencia: %s", task.exception())
+
+async def _bounded(coro: Awaitable[Any]) -> Any:
+    """Ejecuta la corrutina respetando el límite de escrituras simultáneas."""
+    global _background_semaphore
+    if _background_semaphore is None:
+        _background_semaphore = asyncio.Semaphore(MAX_PENDING_WRITES)
+    async with _background_semaphore:
+        return await coro
+
+def _run_in_background(coro: Awaitable[Any]) -> Optional[asyncio.Task]:
+    """
+    Ejecuta una corrutina de persistencia sin bloquear la respuesta al usuario.
+    
+    Args:
+        coro: Corrutina a ejecutar
+        
+    Returns:
+        Tarea creada en el event loop actual, o None si se descartó por exceso de pendientes
+    """
+    if len(_background_tasks) >= MAX_BACKGROUND_TASKS:
+        logger.warning("Demasiadas escrituras pendientes (%d); se descarta la persistencia", len(_background_tasks))
+        coro.close()
+        return None
+    task = asyncio.create_task(_bounded(coro))
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+async def drain_background_tasks(timeout: float = 10) -> None:
+    """
+    Espera a que terminen las escrituras de persistencia pendientes (al detener el servidor).
+    
+    Args:
+        timeout: Tiempo máximo de espera en segundos
+    """
+    if not _background_tasks:
+        return
+    _, pending = await asyncio.wait(set(_background_tasks), timeout=timeout)
+    if pending:
+        logger.warning("%d escrituras de persistencia sin terminar al detener el servidor", len(pending))
+
+# Número máximo de elementos del historial que se reenvían al modelo en cada turno
+MAX_HISTORY_ITEMS = 12
+
+# Comandos para terminar la conversación
+_EXIT_COMMANDS = frozenset({'salir', 'exit', 'quit', 'adios', 'adiós', 'hasta luego', 'bye', 'byebye', 'chao', 'chaochao'})
+
+# Solo los mensajes cortos se consideran como posibles comandos de salida
+_EXIT_CHECK_LENGTH = 30
+
+# Cortesías que pueden acompañar a un comando de salida ("salir por favor", "adiós, gracias");
+# las más largas van primero para que "muchas gracias" no se reconozca solo como "gracias"
+_EXIT_COURTESIES = ("muchas gracias", "por favor", "gracias")
+
+# Respuesta cuando el agente excede el tiempo máximo de procesamiento
+_TIMEOUT_RESPONSE = "Lo siento, la respuesta está tardando más de lo esperado. Por favor, intente de nuevo en unos momentos."
+
+# Prefijo del mensaje de sistema con las disponibilidades vigentes
+_SLOTS_CONTEXT_PREFIX = "Disponibilidades actuales: "
+
+def _is_slots_context(item: Dict[str, Any]) -> bool:
+    """Indica si un elemento de la entrada es el mensaje efímero de disponibilidades."""
+    return item.get("role") == "system" and str(item.get("content", "")).startswith(_SLOTS_CONTEXT_PREFIX)
 
 class TourismAgent:
     """
@@ -18,15 +139,27 @@ class TourismAgent:
     Gestiona la conversación, el contexto y la interacción con servicios externos.
     """
     
-    def __init__(self):
-        """Inicializa el agente de turismo."""
+    def __init__(self, user_id: str = "anonymous"):
+        """
+        Inicializa el agente de turismo.
+        
+        Args:
+            user_id: ID del usuario dueño de la conversación
+        """
         self.agent = self._configure_agent()
+        self.user_id = user_id
         self.conversation_id = str(uuid.uuid4())
         self.conversation_start_time = datetime.now(timezone.utc).isoformat()
         self.conversation_history = []
+        self.message_count = 0
         self.user_profile = {}
         self.available_slots_data = []
-        self.exit_commands = {'salir', 'exit', 'quit', 'adios', 'adiós', 'hasta luego', 'bye', 'byebye', 'chao', 'chaochao'}
+        self.slots_context: Optional[Dict[str, str]] = None
+        self.exit_commands = _EXIT_COMMANDS
+        # Cola de turnos pendientes: preserva el orden dentro de la conversación
+        # sin bloquear las conversaciones de otros usuarios
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumer_task: Optional[asyncio.Task] = None
     
     def _configure_agent(self) -> Agent:
         """
@@ -103,6 +236,116 @@ class TourismAgent:
             tools=[get_slots, schedule_appointment],
         )
     
+    def _is_exit_command(self, message: str) -> bool:
+        """
+        Indica si el mensaje es un comando de salida (ej. "salir", "adiós", "salir por favor").
+        
+        Solo cuenta el comando exacto o seguido de una cortesía: "salir del hotel a las 10"
+        o "adiós al estrés" no terminan la conversación.
+        
+        Args:
+            message: Mensaje del usuario
+            
+        Returns:
+            True si el usuario quiere terminar la conversación
+        """
+        text = message.strip()
+        # Los mensajes largos no son comandos de salida; se evita convertirlos a minúsculas
+        if not text or len(text) > _EXIT_CHECK_LENGTH:
+            return False
+        
+        text = text.lower().strip(" .,!¡")
+        if text in self.exit_commands:
+            return True
+        for courtesy in _EXIT_COURTESIES:
+            if text.endswith(courtesy):
+                return text[:-len(courtesy)].rstrip(" .,!¡") in self.exit_commands
+        return False
+    
+    async def _run_agent(self, agent_input: List[Dict[str, Any]]):
+        """
+        Ejecuta el agente acotando el tiempo de espera a AGENT_TIMEOUT segundos.
+        
+        Args:
+            agent_input: Lista de mensajes de entrada para el agente
+            
+        Returns:
+            Resultado de la ejecución del agente
+            
+        Raises:
+            asyncio.TimeoutError: Si el agente no responde a tiempo
+        """
+        return await asyncio.wait_for(Runner.run(self.agent, agent_input), timeout=AGENT_TIMEOUT)
+    
+    async def _enqueue(self, handler: Callable[..., Awaitable[str]], *args: Any) -> str:
+        """
+        Encola un turno de la conversación y espera su resultado.
+        
+        Args:
+            handler: Método que procesa el turno
+            *args: Argumentos del método
+            
+        Returns:
+            Respuesta generada por el agente
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((handler, args, future))
+        
+        # El consumidor se crea con el primer turno y termina cuando la cola se vacía
+        if self._consumer_task is None:
+            self._consumer_task = asyncio.create_task(self._consume_queue())
+        return await future
+    
+    async def _consume_queue(self) -> None:
+        """Procesa los turnos encolados uno a uno, en orden de llegada."""
+        try:
+            while not self._queue.empty():
+                handler, args, future = self._queue.get_nowait()
+                if future.cancelled():
+                    continue
+                try:
+                    result = await handler(*args)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                except BaseException:
+                    # Cancelación u otra salida abrupta: quien espera el turno no queda bloqueado
+                    if not future.done():
+                        future.cancel()
+                    raise
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._consumer_task = None
+            # Si el consumidor terminó de forma abrupta, los turnos que siguen en cola ya no
+            # tienen quien los procese: se cancelan para que sus _enqueue no esperen para siempre
+            while not self._queue.empty():
+                _, _, pending = self._queue.get_nowait()
+                if not pending.done():
+                    pending.cancel()
+    
+    def _trim_history(self) -> None:
+        """
+        Limita el historial a una ventana deslizante de MAX_HISTORY_ITEMS elementos.
+        
+        Conserva solo los elementos más recientes, sin dejar al inicio de la ventana salidas
+        de herramientas cuya llamada fue recortada. No se fija ningún mensaje: el prompt de
+        sistema vive en Agent.instructions y los mensajes de sistema del historial son de
+        cada turno (p. ej. los avisos de webhook), así que envejecen como el resto.
+        """
+        history = self.conversation_history
+        if len(history) <= MAX_HISTORY_ITEMS:
+            return
+        
+        start = len(history) - MAX_HISTORY_ITEMS
+        while start < len(history) and history[start].get("type") == "function_call_output":
+            start += 1
+        
+        del history[:start]
+    
     async def process_webhook_data(self, webhook_data: Dict[str, Any]) -> str:
         """
         Procesa datos recibidos del webhook y genera una respuesta adecuada.
@@ -113,6 +356,10 @@ class TourismAgent:
         Returns:
             Mensaje de respuesta generado por el agente
         """
+        return await self._enqueue(self._handle_webhook_data, webhook_data)
+    
+    async def _handle_webhook_data(self, webhook_data: Dict[str, Any]) -> str:
+        """Procesa un turno de webhook (ejecutado por el consumidor de la cola)."""
         # Validar y extraer tipo de mensaje
         message_type = webhook_data.get("type", "unknown")
         content = webhook_data.get("content", "")
@@ -134,27 +381,31 @@ class TourismAgent:
         else:
             system_message["content"] += f"Mensaje recibido: {content}"
         
-        # Añadir mensaje al historial
-        if self.conversation_history:
-            history_with_new_message = self.conversation_history + [system_message]
-        else:
-            history_with_new_message = [system_message]
+        # Añadir mensaje a una copia del historial (una sola lista nueva por turno)
+        history_with_new_message = self.conversation_history.copy()
+        history_with_new_message.append(system_message)
         
         # Ejecutar el agente con el mensaje nuevo
-        result = await Runner.run(self.agent, history_with_new_message)
+        try:
+            result = await self._run_agent(history_with_new_message)
+        except asyncio.TimeoutError:
+            logger.warning("Tiempo agotado procesando webhook de tipo '%s'", message_type)
+            return _TIMEOUT_RESPONSE
         
         # Actualizar historial
         self.conversation_history = result.to_input_list()
+        self.message_count += 1
+        self._trim_history()
         
-        # Guardar en Supabase si está disponible
+        # Guardar en Supabase sin añadir la latencia de la base de datos a la respuesta
         if user_id:
-            await supabase_service.save_conversation_turn(
+            _run_in_background(get_supabase_service().save_conversation_turn(
                 conversation_id=self.conversation_id,
                 user_identifier=user_id,
                 user_message=f"WEBHOOK: {message_type}",
                 agent_response=result.final_output,
                 metadata={"webhook_data": webhook_data}
-            )
+            ))
             
         return result.final_output
     
@@ -169,55 +420,58 @@ class TourismAgent:
         Returns:
             Respuesta generada por el agente
         """
+        return await self._enqueue(self._handle_user_message, message, user_id)
+    
+    async def _handle_user_message(self, message: str, user_id: str) -> str:
+        """Procesa un turno de mensaje de usuario (ejecutado por el consumidor de la cola)."""
         # Verificar si el usuario quiere salir
-        if message.lower() in self.exit_commands:
+        if self._is_exit_command(message):
             return "¡Gracias por contactarnos! Esperamos darle la bienvenida pronto a nuestras experiencias. ¡Buen viaje!"
         
         # Extraer datos potencialmente persistentes del mensaje del usuario
-        user_data_patterns = {
-            "name": r"(?:me\s+llamo|soy|nombre\s+es)\s+([A-Za-zÀ-ÿ\s]+)(?:\.|,|\s|$)",
-            "email": r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}",
-            "phone": r"(?:\+\d{1,3}[\s-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}"
-        }
-        
-        detected_user_data = {}
-        for key, pattern in user_data_patterns.items():
-            match = re.search(pattern, message)
-            if match and key == "name":
-                detected_user_data[key] = match.group(1).strip()
-            elif match:
-                detected_user_data[key] = match.group(0)
+        detected_user_data = _extract_user_data(message)
         
         # Actualizar la información del usuario y guardarlo si es posible
         if detected_user_data and user_id != "anonymous":
             self.user_profile.update(detected_user_data)
-            await supabase_service.update_user_profile(user_id, detected_user_data)
+            _run_in_background(get_supabase_service().update_user_profile(user_id, detected_user_data))
         
         # Ejecutar el agente con el mensaje del usuario
         input_list = self.conversation_history + [{"role": "user", "content": message}] if self.conversation_history else [{"role": "user", "content": message}]
-        result = await Runner.run(self.agent, input_list)
         
-        # Actualizar historial de conversación
-        self.conversation_history = result.to_input_list()
+        # Las disponibilidades vigentes van al final de la entrada y no al historial,
+        # para que el prefijo de la conversación se mantenga estable entre turnos (prompt caching)
+        if self.slots_context:
+            input_list.append(self.slots_context)
+        try:
+            result = await self._run_agent(input_list)
+        except asyncio.TimeoutError:
+            logger.warning("Tiempo agotado procesando mensaje del usuario %s", user_id)
+            return _TIMEOUT_RESPONSE
         
-        # Detectar si se obtuvieron slots disponibles
-        tool_calls = [item for item in result.new_items 
-                     if hasattr(item, 'tool_call') and item.tool_call]
+        # Actualizar historial de conversación (sin el contexto efímero de disponibilidades)
+        self.conversation_history = [item for item in result.to_input_list() if not _is_slots_context(item)]
+        self.message_count += 1
+        self._trim_history()
         
-        for item in tool_calls:
-            if item.tool_call.name == "get_slots" and hasattr(item, 'tool_result'):
-                tool_result = item.tool_result
-                if isinstance(tool_result, dict) and 'available_slots' in tool_result:
-                    self.available_slots_data = tool_result['available_slots']
+        # Detectar si se obtuvieron slots disponibles (una sola pasada; se usa el resultado más reciente)
+        for item in reversed(result.new_items):
+            tool_call = getattr(item, 'tool_call', None)
+            if not tool_call or tool_call.name != "get_slots":
+                continue
+            tool_result = getattr(item, 'tool_result', None)
+            if isinstance(tool_result, dict) and 'available_slots' in tool_result:
+                self.available_slots_data = tool_result['available_slots']
+                break
                     
-        # Guardar en Supabase
-        await supabase_service.save_conversation_turn(
+        # Guardar en Supabase sin añadir la latencia de la base de datos a la respuesta
+        _run_in_background(get_supabase_service().save_conversation_turn(
             conversation_id=self.conversation_id,
             user_identifier=user_id,
             user_message=message,
             agent_response=result.final_output,
             metadata={"available_slots": len(self.available_slots_data)}
-        )
+        ))
         
         # Añadir información sobre los slots disponibles para la siguiente interacción
         if self.available_slots_data:
@@ -227,9 +481,9 @@ class TourismAgent:
                 for slot in self.available_slots_data[:9]  # Limitamos a 9 slots
             ]
             
-            # Añadimos esta información al contexto del sistema
-            context_message = f"Disponibilidades actuales: {simple_slots}"
-            self.conversation_history.append({"role": "system", "content": context_message})
+            # Guardamos esta información para enviarla al final de la siguiente entrada
+            context_message = f"{_SLOTS_CONTEXT_PREFIX}{simple_slots}"
+            self.slots_context = {"role": "system", "content": context_message}
             
         return result.final_output
     
@@ -245,23 +499,53 @@ class TourismAgent:
                 *self.conversation_history[-10:]  # Usamos los últimos 10 mensajes para el resumen
             ]
             
-            summary_result = await Runner.run(self.agent, summary_input)
-            conversation_summary = summary_result.final_output
+            # Lanzar el resumen y preparar el resto de los datos mientras el modelo responde
+            summary_task = asyncio.create_task(self._run_agent(summary_input))
             
-            # Obtener user_identifier
-            user_identifier = self.user_profile.get("identifier", "anonymous")
+            user_identifier = self.user_id
+            end_time = datetime.now(timezone.utc).isoformat()
+            message_count = self.message_count
             
-            # Guardar el resumen
-            await supabase_service.save_conversation_summary(
+            summary_result = await summary_task
+            conversation_summary = summary_result.final_output
+            
+            # Guardar el resumen y los datos de contacto del usuario en una sola llamada;
+            # el usuario anónimo no tiene perfil propio, así que solo se guarda el resumen
+            profile_patch = None
+            if user_identifier != "anonymous":
+                profile_patch = {key: value for key, value in self.user_profile.items() if key != "identifier"}
+            await get_supabase_service().close_conversation(
                 conversation_id=self.conversation_id,
                 user_identifier=user_identifier,
                 summary=conversation_summary,
                 start_time=self.conversation_start_time,
-                end_time=datetime.now(timezone.utc).isoformat(),
-                message_count=len(self.conversation_history) // 2  # Aproximado
+                end_time=end_time,
+                message_count=message_count,
+                profile_patch=profile_patch
             )
-        except Exception as e:
-            print(f"⚠️ Error al guardar resumen: {str(e)}")
+        except Exception:
+            logger.exception("Error al guardar resumen")
             
-# Instancia global del agente
-tourism_agent = TourismAgent() 
\ No newline at end of file
+# Registro de agentes por usuario: cada usuario conserva su propio estado de conversación.
+# TTLCache acota la memoria y descarta las conversaciones inactivas.
+MAX_ACTIVE_CONVERSATIONS = 10_000
+CONVERSATION_TTL = 3600  # 1 hora de inactividad
+
+_agents: TTLCache = TTLCache(maxsize=MAX_ACTIVE_CONVERSATIONS, ttl=CONVERSATION_TTL)
+
+def get_agent(user_id: str) -> TourismAgent:
+    """
+    Obtiene el agente asociado a un usuario, creándolo si no existe.
+    
+    Args:
+        user_id: ID del usuario
+        
+    Returns:
+        Instancia de TourismAgent con la conversación de ese usuario
+    """
+    agent = _agents.get(user_id)
+    if agent is None:
+        agent = TourismAgent(user_id)
+    # Reinsertar renueva el tiempo de vida mientras la conversación siga activa
+    _agents[user_id] = agent
+    return agent 
\ No newline at end of file
@@ -3,26 +3,62 @@ Punto de entrada principal de la aplicación.
 Configura y ejecuta el servidor web con FastAPI.
 """
 import os
+import queue
 import logging
+from typing import Optional
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 from app.infrastructure.config.config.settings import WEBHOOK_PORT, WEBHOOK_HOST
-from app.presentation.webhook.routes import router as webhook_router
+from app.presentation.webhook.routes import (
+    router as webhook_router,
+    close_rate_limiter,
+    start_rate_limit_cleanup,
+)
+from app.application.services.tools.calendar_tools import close_session
+from app.services.supabase_service import start_supabase_service, close_supabase_service
+from app.agents.tourism_agent import drain_background_tasks
 
 # Configuración de logging con nivel configurable
 log_level = os.getenv("LOG_LEVEL", "INFO")
 numeric_level = getattr(logging, log_level.upper(), logging.INFO)
+log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+log_handlers = [logging.StreamHandler(), logging.FileHandler("app.log")]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
 logging.basicConfig(
     level=numeric_level,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
+    handlers=log_handlers
 )
 
+# En cada worker los registros se encolan y un hilo aparte los escribe en consola y archivo,
+# para que la escritura no bloquee el event loop. El hilo se crea al arrancar el worker y no
+# al importar: con preload_app Gunicorn importa la app en el maestro y los hilos no
+# sobreviven al fork, así que la cola del worker quedaría sin nadie que la vacíe
+log_listener: Optional[QueueListener] = None
+
+def start_log_listener() -> None:
+    """Envía el logging del worker a una cola atendida por un hilo propio."""
+    global log_listener
+    if log_listener is not None:
+        return
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    logging.getLogger().handlers = [QueueHandler(log_queue)]
+
+def stop_log_listener() -> None:
+    """Vuelve a escribir directamente, vacía la cola pendiente y detiene su hilo."""
+    global log_listener
+    if log_listener is None:
+        return
+    logging.getLogger().handlers = list(log_handlers)
+    log_listener.stop()
+    log_listener = None
+
 logger = logging.getLogger(__name__)
 
 # Crear la aplicación FastAPI con metadatos mejorados
@@ -33,6 +69,7 @@ app = FastAPI(
     root_path=os.getenv("ROOT_PATH", ""),  # Para configuración de subdominios o rutas base
     docs_url="/docs",
     redoc_url="/redoc",
+    default_response_class=ORJSONResponse,  # Serialización JSON con orjson
     openapi_tags=[
         {"name": "webhook", "description": "Operaciones relacionadas con el webhook"},
         {"name": "health", "description": "Verificaciones de estado del sistema"}
@@ -56,12 +93,33 @@ app.add_middleware(
 # Registrar los routers
 app.include_router(webhook_router)
 
+# El hilo de logging se inicia en el propio worker, antes que el resto del arranque
+app.add_event_handler("startup", start_log_listener)
+
+# Limpieza periódica del historial de rate limiting fuera del camino de cada solicitud
+app.add_event_handler("startup", start_rate_limit_cleanup)
+
+# El cliente de Supabase se crea en cada worker al arrancar, no al importar la aplicación,
+# y su estado de salud se verifica en segundo plano
+app.add_event_handler("startup", start_supabase_service)
+
+# Liberar recursos compartidos al detener el servidor
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Cierra las sesiones HTTP compartidas, la limpieza del rate limiting, Redis, las escrituras pendientes y el hilo de logging."""
+    await close_session()
+    await close_rate_limiter()
+    # Las escrituras en segundo plano terminan antes de cerrar el cliente de Supabase
+    await drain_background_tasks()
+    await close_supabase_service()
+    stop_log_listener()
+
 # Manejador global de excepciones
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Manejador global de excepciones."""
-    logger.error(f"Error no manejado: {str(exc)}")
-    return JSONResponse(
+    logger.error("Error no manejado: %s", exc)
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Error interno del servidor", "detail": str(exc)}
     )
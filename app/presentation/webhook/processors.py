@@ -7,16 +7,20 @@ Este módulo contiene las funciones para procesar y validar los mensajes recibid
 
 import hmac
 import hashlib
-import json
 import logging
 import asyncio
+import aiohttp
+import orjson
 from typing import Dict, Any, Callable, Optional
 
-from app.agents.tourism_agent import tourism_agent
+from app.agents.tourism_agent import get_agent
 
 # Configurar logging
 logger = logging.getLogger("webhook")
 
+# Constructor de hash resuelto una sola vez (hashlib usa la implementación de OpenSSL)
+_SHA256 = hashlib.sha256
+
 def validate_signature(payload: bytes, signature: str, secret: str) -> bool:
     """
     Valida la firma HMAC de un payload.
@@ -48,13 +52,13 @@ def validate_signature(payload: bytes, signature: str, secret: str) -> bool:
         calculated_hmac = hmac.new(
             secret,
             payload,
-            hashlib.sha256
+            _SHA256
         ).hexdigest()
         
         # Comparar firmas (comparación de tiempo constante)
         return hmac.compare_digest(calculated_hmac, signature)
     except Exception as e:
-        logger.error(f"Error al validar firma: {str(e)}")
+        logger.error("Error al validar firma: %s", e)
         return False
 
 def generate_signature(payload: Dict[str, Any], secret: str) -> str:
@@ -62,7 +66,8 @@ def generate_signature(payload: Dict[str, Any], secret: str) -> str:
     Genera una firma HMAC para un payload.
     
     Esta función es útil para sistemas que necesitan enviar webhooks
-    firmados hacia otros servicios.
+    firmados hacia otros servicios. El payload se firma sobre su forma JSON
+    compacta con claves ordenadas, que es la que debe reproducir el receptor.
     
     Args:
         payload: Diccionario con datos a firmar
@@ -71,8 +76,8 @@ def generate_signature(payload: Dict[str, Any], secret: str) -> str:
     Returns:
         Firma hexadecimal del payload
     """
-    # Convertir payload a JSON y luego a bytes
-    payload_bytes = json.dumps(payload).encode()
+    # Serializar el payload directamente a bytes canónicos (claves ordenadas para una firma determinista)
+    payload_bytes = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
     
     # Convertir secret a bytes si es string
     if isinstance(secret, str):
@@ -82,7 +87,7 @@ def generate_signature(payload: Dict[str, Any], secret: str) -> str:
     return hmac.new(
         secret,
         payload_bytes,
-        hashlib.sha256
+        _SHA256
     ).hexdigest()
 
 async def process_message(message_data: Dict[str, Any]) -> None:
@@ -97,7 +102,7 @@ async def process_message(message_data: Dict[str, Any]) -> None:
     """
     try:
         # Registrar la recepción del mensaje
-        logger.info(f"Procesando mensaje tipo: {message_data.get('type')}")
+        logger.info("Procesando mensaje tipo: %s", message_data.get('type'))
         
         # Validar campos mínimos
         if "type" not in message_data or "content" not in message_data:
@@ -105,12 +110,18 @@ async def process_message(message_data: Dict[str, Any]) -> None:
             return
             
         # Enviar al agente para procesamiento
-        response = await tourism_agent.process_webhook_data(message_data)
+        # Cada usuario tiene su propia conversación con el agente
+        agent = get_agent(message_data.get("user_id") or "anonymous")
+        response = await agent.process_webhook_data(message_data)
         
         # Registrar respuesta del agente
-        logger.info(f"Agente procesó mensaje: {response[:100]}...")
-    except Exception as e:
-        logger.error(f"Error procesando mensaje: {str(e)}")
+        if response:
+            logger.info("Agente procesó mensaje: %s...", response[:100])
+        else:
+            logger.warning("Agente devolvió respuesta vacía")
+    except (asyncio.TimeoutError, aiohttp.ClientError, ConnectionError) as e:
+        # Solo fallos esperados de red o tiempo; cualquier otro error debe hacerse visible
+        logger.error("Error procesando mensaje: %s", e)
 
 def format_webhook_data(data: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -7,60 +7,139 @@ Define los endpoints HTTP para recibir y procesar mensajes externos.
 import os
 import hmac
 import hashlib
-import json
 import time
 import asyncio
-from datetime import datetime
-from typing import Dict, Any, Optional
+import logging
+import orjson
+import redis.asyncio as redis
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, Any, Optional
 
 from fastapi import APIRouter, Request, Depends, HTTPException, Header, Body, BackgroundTasks
 from fastapi.responses import JSONResponse
 
-from app.infrastructure.config.config.settings import WEBHOOK_SECRET
+from app.infrastructure.config.config.settings import WEBHOOK_SECRET, REDIS_URL
 from app.domain.entities.models import WebhookMessage, WebhookResponse, AgentRequest
-from app.agents.tourism_agent import tourism_agent
+from app.agents.tourism_agent import get_agent
 from app.presentation.webhook.processors import process_message, validate_signature
 
+logger = logging.getLogger("webhook")
+
 # Crear router para los endpoints del webhook
 router = APIRouter(prefix="/webhook", tags=["webhook"])
 
 # Constantes para seguridad y rendimiento
 MAX_PAYLOAD_SIZE = 1024 * 1024  # 1MB
-REQUEST_TIMEOUT = 10  # 10 segundos
 RATE_LIMIT = 50  # 50 solicitudes por minuto
 RATE_WINDOW = 60  # Ventana de 60 segundos
 
-# Control de tasa de solicitudes (rate limiting)
-request_history = {}
+# Control de tasa de solicitudes (rate limiting) compartido entre workers mediante Redis.
+# El script incrementa el contador de la IP y fija su expiración en la primera solicitud de la ventana.
+_RATE_LIMIT_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return count
+"""
+# Tiempos de espera cortos: si Redis no responde se aplica de inmediato el control local
+# en lugar de bloquear cada solicitud esperando la conexión
+_redis = redis.Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=0.2,
+    socket_timeout=0.2,
+) if REDIS_URL else None
+_rate_limit_script = _redis.register_script(_RATE_LIMIT_SCRIPT) if _redis else None
+
+# Tras un fallo de Redis se usa solo el control local durante REDIS_RETRY_BACKOFF segundos,
+# para no esperar el timeout de conexión en cada solicitud ni registrar un aviso por cada una
+REDIS_RETRY_BACKOFF = 30
+_redis_retry_at = 0.0
 
-def check_rate_limit(client_ip: str) -> bool:
+# Control local (por worker) cuando Redis no está configurado o no responde
+# Cada IP guarda sus marcas de tiempo en orden creciente dentro de una deque
+request_history: Dict[str, Deque[int]] = {}
+RATE_CLEANUP_INTERVAL = 30  # Segundos entre limpiezas del historial local
+_cleanup_task: Optional[asyncio.Task] = None
+
+async def check_rate_limit(client_ip: str) -> bool:
     """
     Verifica si una IP ha excedido el límite de solicitudes.
     
+    Usa un contador atómico en Redis para que el límite sea único entre todos
+    los workers de Gunicorn; si Redis no está disponible, aplica el control local.
+    
     Args:
         client_ip: Dirección IP del cliente
         
     Returns:
         True si está dentro del límite, False si excede
     """
-    current_time = int(time.time())
+    global _redis_retry_at
+    if _rate_limit_script is not None and time.monotonic() >= _redis_retry_at:
+        try:
+            count = await _rate_limit_script(keys=[f"rl:{client_ip}"], args=[RATE_WINDOW])
+        except redis.RedisError as e:
+            # Un solo aviso por caída: durante la espera no se vuelve a intentar
+            if not _redis_retry_at:
+                logger.warning("Redis no disponible para rate limiting, se usa el control local: %s", e)
+            _redis_retry_at = time.monotonic() + REDIS_RETRY_BACKOFF
+        else:
+            if _redis_retry_at:
+                logger.info("Redis disponible de nuevo para rate limiting")
+                _redis_retry_at = 0.0
+            return count <= RATE_LIMIT
     
-    # Limpiar entradas antiguas
-    for ip in list(request_history.keys()):
-        request_history[ip] = [ts for ts in request_history[ip] if ts > current_time - RATE_WINDOW]
-        if not request_history[ip]:
+    return _check_local_rate_limit(client_ip)
+
+async def _rate_cleanup_loop() -> None:
+    """Elimina periódicamente del historial local las IPs sin solicitudes recientes."""
+    while True:
+        await asyncio.sleep(RATE_CLEANUP_INTERVAL)
+        cutoff = int(time.time()) - RATE_WINDOW
+        stale_ips = [ip for ip, timestamps in request_history.items()
+                     if not timestamps or timestamps[-1] <= cutoff]
+        for ip in stale_ips:
             del request_history[ip]
+
+async def start_rate_limit_cleanup() -> None:
+    """Inicia la tarea de limpieza del historial local de rate limiting."""
+    global _cleanup_task
+    if _cleanup_task is None:
+        _cleanup_task = asyncio.create_task(_rate_cleanup_loop())
+
+async def close_rate_limiter() -> None:
+    """Detiene la limpieza del historial local y cierra la conexión con Redis si está configurada."""
+    global _cleanup_task
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
+        _cleanup_task = None
+    if _redis is not None:
+        await _redis.aclose()
+
+def _check_local_rate_limit(client_ip: str) -> bool:
+    """
+    Verifica el límite de solicitudes con el historial en memoria del worker.
     
-    # Verificar la IP actual
-    if client_ip not in request_history:
-        request_history[client_ip] = []
+    Args:
+        client_ip: Dirección IP del cliente
+        
+    Returns:
+        True si está dentro del límite, False si excede
+    """
+    current_time = int(time.time())
+    cutoff = current_time - RATE_WINDOW
     
-    # Contar solicitudes en la ventana de tiempo
-    count = len(request_history[client_ip])
+    # Descartar solo las marcas antiguas de la IP actual; las IPs inactivas
+    # se eliminan en segundo plano (_rate_cleanup_loop)
+    timestamps = request_history.setdefault(client_ip, deque())
+    while timestamps and timestamps[0] <= cutoff:
+        timestamps.popleft()
     
     # Permitir si está dentro del límite
-    if count < RATE_LIMIT:
-        request_history[client_ip].append(current_time)
+    if len(timestamps) < RATE_LIMIT:
+        timestamps.append(current_time)
         return True
         
     return False
@@ -86,23 +165,33 @@ async def verify_webhook_request(
     if not x_webhook_signature:
         raise HTTPException(status_code=401, detail="Falta la firma del webhook")
     
-    # Leer el cuerpo de la solicitud
+    # Rechazar de inmediato si el tamaño declarado ya excede el máximo
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_PAYLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="Payload demasiado grande")
+    
+    # Leer el cuerpo de la solicitud por partes, abortando en cuanto supere el tamaño máximo
     try:
-        body = await request.body()
-        
-        # Verificar tamaño máximo
-        if len(body) > MAX_PAYLOAD_SIZE:
-            raise HTTPException(status_code=413, detail="Payload demasiado grande")
+        chunks = []
+        total_size = 0
+        async for chunk in request.stream():
+            total_size += len(chunk)
+            if total_size > MAX_PAYLOAD_SIZE:
+                raise HTTPException(status_code=413, detail="Payload demasiado grande")
+            chunks.append(chunk)
+        body = b"".join(chunks)
         
         # Validar firma con el secreto compartido
         if not validate_signature(body, x_webhook_signature, WEBHOOK_SECRET):
             raise HTTPException(status_code=401, detail="Firma del webhook inválida")
         
         # Parsear JSON
-        payload = json.loads(body)
+        payload = orjson.loads(body)
         return payload
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=400, detail="JSON inválido")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al procesar la solicitud: {str(e)}")
 
@@ -125,9 +214,12 @@ async def receive_webhook(
     """
     # Verificar rate limit por IP
     client_ip = request.client.host if request.client else "unknown"
-    if not check_rate_limit(client_ip):
+    if not await check_rate_limit(client_ip):
         raise HTTPException(status_code=429, detail="Demasiadas solicitudes")
     
+    # Marca de tiempo de recepción, calculada una sola vez por solicitud
+    received_at = datetime.now(timezone.utc).isoformat()
+    
     # Validar que payload tiene los campos requeridos
     if "type" not in payload or "content" not in payload:
         raise HTTPException(status_code=400, detail="Faltan campos requeridos (type, content)")
@@ -138,7 +230,7 @@ async def receive_webhook(
             type=payload["type"],
             content=payload["content"],
             user_id=payload.get("user_id"),
-            timestamp=payload.get("timestamp", datetime.now().isoformat()),
+            timestamp=payload.get("timestamp") or received_at,
             metadata=payload.get("metadata", {})
         )
     except Exception as e:
@@ -152,7 +244,7 @@ async def receive_webhook(
         "success": True,
         "message": f"Mensaje de tipo '{webhook_message.type}' recibido y en procesamiento",
         "data": {
-            "received_at": datetime.now().isoformat(),
+            "received_at": received_at,
             "message_id": webhook_message.metadata.get("id", "unknown")
         }
     }
@@ -182,21 +274,22 @@ async def query_agent(
     
     # Verificar rate limit por IP
     client_ip = request.client.host if request.client else "unknown"
-    if not check_rate_limit(client_ip):
+    if not await check_rate_limit(client_ip):
         raise HTTPException(status_code=429, detail="Demasiadas solicitudes")
     
     try:
-        # Consultar directamente al agente
-        response = await tourism_agent.process_user_message(
+        # Consultar directamente al agente del usuario
+        user_id = agent_request.user_id or "webhook_query"
+        response = await get_agent(user_id).process_user_message(
             message=agent_request.message,
-            user_id=agent_request.user_id or "webhook_query"
+            user_id=user_id
         )
         
         return {
             "success": True,
             "message": response,
             "data": {
-                "query_time": datetime.now().isoformat(),
+                "query_time": datetime.now(timezone.utc).isoformat(),
                 "context": agent_request.context
             }
         }
@@ -206,4 +299,4 @@ async def query_agent(
 @router.get("/health")
 async def health_check():
     """Endpoint para verificar el estado del webhook."""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()} 
\ No newline at end of file
+    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()} 
\ No newline at end of file
@@ -3,38 +3,256 @@ Servicio para interactuar con Supabase.
 Este módulo maneja todas las operaciones relacionadas con la base de datos Supabase.
 """
 import uuid
+import asyncio
+import logging
+import weakref
 from datetime import datetime, timezone
 from typing import Dict, List, Optional, Any, Union
-from supabase import create_client, Client
+import httpx
+import orjson
+from cachetools import TTLCache
 
 from app.infrastructure.config.config.settings import SUPABASE_URL, SUPABASE_KEY
 
+logger = logging.getLogger("supabase_service")
+
+# Agrupación de inserciones: se envían hasta MAX_BATCH_SIZE filas por solicitud,
+# esperando como máximo BATCH_WINDOW segundos a que lleguen más filas
+MAX_BATCH_SIZE = 100
+BATCH_WINDOW = 0.01
+
+# Filas por llamada a bulk_insert_turns en cargas masivas (backfill)
+BULK_CHUNK_SIZE = 1000
+
+# Intervalo en segundos entre verificaciones de salud de Supabase
+HEALTH_CHECK_INTERVAL = 5
+
+# Filas como máximo en la cola de cada tabla; mientras Supabase no responde las
+# inserciones se retienen en la cola y, una vez llena, las nuevas se descartan
+MAX_QUEUED_ROWS = 10000
+
+# Tiempo máximo en segundos para enviar las filas encoladas al cerrar el servicio
+CLOSE_FLUSH_TIMEOUT = 5
+
+# Columnas del perfil que usa el agente (identificador y datos de contacto detectados)
+_PROFILE_COLUMNS = "identifier,name,email,phone"
+
+# Columnas de los resúmenes que se devuelven en las conversaciones recientes
+_SUMMARY_COLUMNS = "conversation_id,summary,start_time,end_time,message_count"
+
+# Las claves que falten en alguna fila de un lote toman el valor por defecto de la columna
+_BATCH_INSERT_HEADERS = {"Prefer": "return=minimal,missing=default"}
+
+# Zona horaria UTC resuelta una sola vez para las marcas de tiempo de cada turno
+_UTC = timezone.utc
+
 class SupabaseService:
     """Clase para gestionar las operaciones con Supabase."""
     
+    # Caché de perfiles recientes para evitar una consulta por cada lectura repetida
+    _profile_cache: TTLCache = TTLCache(maxsize=1024, ttl=30)
+    # Un lock por usuario para que las lecturas concurrentes sin caché hagan una sola consulta
+    _profile_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+    
     def __init__(self):
         """Inicializa el servicio de Supabase con las credenciales."""
-        self.client = None
+        self.client: Optional[httpx.AsyncClient] = None
         self.connected = False
+        # Colas de inserción por tabla y sus tareas de envío (se crean con la primera fila)
+        self._insert_queues: Dict[str, asyncio.Queue] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        # Al cerrar ya no se aceptan filas nuevas
+        self._closing = False
+        # Estado de salud actualizado en segundo plano; si Supabase no responde, las lecturas
+        # fallan de inmediato y las inserciones agrupadas esperan en cola a que se recupere
+        self._healthy = False
+        self._health_task: Optional[asyncio.Task] = None
         self._connect()
     
     def _connect(self) -> None:
-        """Establece la conexión con Supabase."""
+        """
+        Configura el cliente HTTP asíncrono contra la API REST (PostgREST) de Supabase.
+        
+        Las consultas se hacen sin bloquear el event loop, a diferencia del cliente
+        síncrono de supabase-py.
+        """
         if not all([SUPABASE_URL, SUPABASE_KEY]):
-            print("⚠️ Advertencia: Las credenciales de Supabase no están configuradas.")
+            logger.warning("Las credenciales de Supabase no están configuradas.")
             return
             
+        # Encabezados fijos construidos una sola vez por instancia.
+        # Con "Prefer: return=minimal" PostgREST no devuelve las filas escritas.
+        self._headers = httpx.Headers({
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {SUPABASE_KEY}",
+            # Los cuerpos se serializan con orjson y se envían como bytes
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal",
+        })
+        
         try:
-            self.client = create_client(SUPABASE_URL, SUPABASE_KEY)
+            self.client = httpx.AsyncClient(
+                base_url=f"{SUPABASE_URL}/rest/v1",
+                headers=self._headers,
+                # HTTP/2 multiplexa las consultas concurrentes sobre la misma conexión
+                http2=True,
+                # Conexiones persistentes: el handshake TCP+TLS se paga una vez por worker
+                limits=httpx.Limits(
+                    max_keepalive_connections=20,
+                    max_connections=100,
+                    keepalive_expiry=60,
+                ),
+            )
             self.connected = True
-            print("✅ Conexión a Supabase establecida correctamente.")
+            self._healthy = True
+            logger.info("Conexión a Supabase establecida correctamente.")
         except Exception as e:
-            print(f"⚠️ Error al conectar con Supabase: {str(e)}")
+            logger.warning("Error al conectar con Supabase: %s", e)
             self.connected = False
     
     def is_connected(self) -> bool:
-        """Verifica si la conexión está activa."""
-        return self.connected and self.client is not None
+        """Verifica si la conexión está activa según la última verificación de salud."""
+        return self._healthy
+    
+    def start_health_check(self) -> None:
+        """Inicia la verificación periódica de salud de Supabase."""
+        if self.client is not None and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_check_loop())
+    
+    async def _health_check_loop(self) -> None:
+        """Consulta periódicamente a PostgREST y actualiza el estado de salud."""
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            try:
+                response = await self.client.head("/user_profiles", params={"limit": 1})
+                healthy = response.is_success
+            except Exception:
+                healthy = False
+            
+            # Registrar solo los cambios de estado
+            if healthy != self._healthy:
+                if healthy:
+                    logger.info("Supabase vuelve a estar disponible")
+                else:
+                    logger.warning("Supabase no disponible; las lecturas se omitirán y las inserciones quedarán en cola hasta que se recupere")
+            self._healthy = healthy
+    
+    async def close(self) -> None:
+        """
+        Detiene la verificación de salud, envía las filas encoladas y cierra el cliente HTTP.
+        
+        Las filas que no se envíen dentro de CLOSE_FLUSH_TIMEOUT se dan por no guardadas.
+        """
+        # Dejar de aceptar filas y vaciar las colas antes de cerrar las conexiones
+        self._closing = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        
+        if self._insert_queues:
+            pending_joins = [asyncio.ensure_future(queue.join()) for queue in self._insert_queues.values()]
+            _, not_flushed = await asyncio.wait(pending_joins, timeout=CLOSE_FLUSH_TIMEOUT)
+            if not_flushed:
+                logger.warning("Cierre de Supabase con filas sin enviar tras %s s", CLOSE_FLUSH_TIMEOUT)
+            for join in not_flushed:
+                join.cancel()
+        
+        for task in self._flush_tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._flush_tasks.values(), return_exceptions=True)
+        
+        # Resolver los futuros de las filas que quedaron sin enviar
+        for queue in self._insert_queues.values():
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                if not future.done():
+                    future.set_result(False)
+        self._insert_queues.clear()
+        self._flush_tasks.clear()
+        
+        if self.client is not None:
+            await self.client.aclose()
+    
+    async def _insert_batched(self, table: str, row: Dict[str, Any]) -> bool:
+        """
+        Encola una fila para insertarla junto con otras en una sola solicitud.
+        
+        Args:
+            table: Nombre de la tabla
+            row: Fila a insertar
+            
+        Returns:
+            True si el lote que contenía la fila se guardó correctamente
+        """
+        if self._closing:
+            return False
+        
+        queue = self._insert_queues.get(table)
+        if queue is None:
+            queue = self._insert_queues[table] = asyncio.Queue(maxsize=MAX_QUEUED_ROWS)
+            self._flush_tasks[table] = asyncio.create_task(self._flush_inserts(table, queue))
+        
+        future = asyncio.get_running_loop().create_future()
+        try:
+            queue.put_nowait((row, future))
+        except asyncio.QueueFull:
+            logger.warning("Cola de inserción de %s llena; se descarta la fila", table)
+            return False
+        return await future
+    
+    async def _flush_inserts(self, table: str, queue: asyncio.Queue) -> None:
+        """
+        Envía en lotes las filas encoladas para una tabla.
+        
+        Args:
+            table: Nombre de la tabla
+            queue: Cola con pares (fila, futuro) pendientes
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            # Esperar la primera fila y reunir las que lleguen dentro de la ventana
+            batch = [await queue.get()]
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            rows = [row for row, _ in batch]
+            # PostgREST exige las mismas claves en todas las filas de un lote salvo que se
+            # indiquen las columnas; las que falten en una fila toman el valor por defecto
+            # de la columna (missing=default) en lugar de NULL
+            columns = ",".join({key for row in rows for key in row})
+            try:
+                # Mientras Supabase no responde el lote se retiene; al cerrar se intenta igualmente
+                while not self._healthy and not self._closing:
+                    await asyncio.sleep(1)
+                response = await self.client.post(
+                    f"/{table}",
+                    params={"columns": columns},
+                    headers=_BATCH_INSERT_HEADERS,
+                    content=orjson.dumps(rows),
+                )
+                response.raise_for_status()
+                saved = True
+            except asyncio.CancelledError:
+                # Cierre del servicio con el lote retenido o en vuelo: se da por no guardado
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(False)
+                raise
+            except Exception as e:
+                logger.warning("Error al guardar lote en %s: %s", table, e)
+                saved = False
+            
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(saved)
+                queue.task_done()
     
     async def save_conversation_turn(self, 
                                     conversation_id: str,
@@ -55,7 +273,8 @@ class SupabaseService:
         Returns:
             True si se guardó correctamente, False en caso contrario
         """
-        if not self.is_connected():
+        # Sin cliente no hay dónde guardar; si Supabase no responde, la fila espera en cola
+        if self.client is None:
             return False
             
         try:
@@ -63,19 +282,50 @@ class SupabaseService:
             conversation_data = {
                 "conversation_id": conversation_id,
                 "user_identifier": user_identifier,
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": datetime.now(_UTC).isoformat(timespec="milliseconds"),
                 "user_message": user_message,
-                "agent_response": agent_response,
-                "metadata": metadata or {}
+                "agent_response": agent_response
             }
+            # Los metadatos vacíos no se envían
+            if metadata:
+                conversation_data["metadata"] = metadata
             
-            # Guardar en la tabla de historial
-            response = self.client.table("conversation_history").insert(conversation_data).execute()
-            return True
+            # Guardar en la tabla de historial (agrupado con otros turnos concurrentes)
+            return await self._insert_batched("conversation_history", conversation_data)
         except Exception as e:
-            print(f"⚠️ Error al guardar conversación: {str(e)}")
+            logger.warning("Error al guardar conversación: %s", e)
             return False
     
+    async def bulk_insert_turns(self, turns: List[Dict[str, Any]]) -> int:
+        """
+        Inserta turnos de conversación en bloque mediante la función RPC bulk_insert_turns.
+        
+        Pensado para cargas masivas (backfill): cada llamada envía hasta
+        BULK_CHUNK_SIZE filas que PostgreSQL inserta en una sola sentencia.
+        
+        Args:
+            turns: Filas de conversation_history a insertar
+            
+        Returns:
+            Número de filas insertadas correctamente
+        """
+        if not self.is_connected():
+            return 0
+        
+        inserted = 0
+        for start in range(0, len(turns), BULK_CHUNK_SIZE):
+            chunk = turns[start:start + BULK_CHUNK_SIZE]
+            try:
+                response = await self.client.post(
+                    "/rpc/bulk_insert_turns",
+                    content=orjson.dumps({"p": chunk}),
+                )
+                response.raise_for_status()
+                inserted += len(chunk)
+            except Exception as e:
+                logger.warning("Error en inserción masiva de turnos (%s filas): %s", len(chunk), e)
+        return inserted
+    
     async def load_user_profile(self, user_identifier: str) -> Optional[Dict[str, Any]]:
         """
         Carga el perfil de un usuario.
@@ -88,17 +338,44 @@ class SupabaseService:
         """
         if not self.is_connected() or not user_identifier:
             return None
+        
+        # Responder desde la caché si el perfil se consultó recientemente
+        profile = self._profile_cache.get(user_identifier)
+        if profile is not None:
+            return profile
+        
+        lock = self._profile_locks.get(user_identifier)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._profile_locks[user_identifier] = lock
             
-        try:
-            # Buscar perfil del usuario en la tabla de perfiles
-            response = self.client.table("user_profiles").select("*").eq("identifier", user_identifier).execute()
+        async with lock:
+            # Otra solicitud pudo haber cargado el perfil mientras se esperaba el lock
+            profile = self._profile_cache.get(user_identifier)
+            if profile is not None:
+                return profile
             
-            if response.data and len(response.data) > 0:
-                return response.data[0]
-            return None
-        except Exception as e:
-            print(f"⚠️ Error al cargar perfil de usuario: {str(e)}")
-            return None
+            try:
+                # Buscar perfil del usuario en la tabla de perfiles (una sola fila, solo las columnas usadas)
+                response = await self.client.get(
+                    "/user_profiles",
+                    params={
+                        "select": _PROFILE_COLUMNS,
+                        "identifier": f"eq.{user_identifier}",
+                        "limit": 1,
+                    },
+                )
+                response.raise_for_status()
+                data = orjson.loads(response.content)
+                
+                if data:
+                    profile = data[0]
+                    self._profile_cache[user_identifier] = profile
+                    return profile
+                return None
+            except Exception as e:
+                logger.warning("Error al cargar perfil de usuario: %s", e)
+                return None
     
     async def update_user_profile(self, user_identifier: str, data: Dict[str, Any]) -> bool:
         """
@@ -116,10 +393,17 @@ class SupabaseService:
             
         try:
             # Actualizar datos del usuario
-            self.client.table("user_profiles").update(data).eq("identifier", user_identifier).execute()
+            response = await self.client.patch(
+                "/user_profiles",
+                params={"identifier": f"eq.{user_identifier}"},
+                content=orjson.dumps(data),
+            )
+            response.raise_for_status()
+            # Invalidar el perfil en caché para que la siguiente lectura refleje el cambio
+            self._profile_cache.pop(user_identifier, None)
             return True
         except Exception as e:
-            print(f"⚠️ Error al actualizar perfil de usuario: {str(e)}")
+            logger.warning("Error al actualizar perfil de usuario: %s", e)
             return False
     
     async def save_conversation_summary(self, 
@@ -143,7 +427,8 @@ class SupabaseService:
         Returns:
             True si se guardó correctamente, False en caso contrario
         """
-        if not self.is_connected():
+        # Sin cliente no hay dónde guardar; si Supabase no responde, la fila espera en cola
+        if self.client is None:
             return False
             
         try:
@@ -157,20 +442,142 @@ class SupabaseService:
                 "message_count": message_count
             }
             
-            # Guardar en la tabla de resúmenes
-            self.client.table("conversation_summaries").insert(summary_data).execute()
+            # Guardar en la tabla de resúmenes (agrupado con otros resúmenes concurrentes)
+            return await self._insert_batched("conversation_summaries", summary_data)
+        except Exception as e:
+            logger.warning("Error al guardar resumen: %s", e)
+            return False
+    
+    async def close_conversation(self,
+                                 conversation_id: str,
+                                 user_identifier: str,
+                                 summary: str,
+                                 start_time: str,
+                                 end_time: str,
+                                 message_count: int,
+                                 profile_patch: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Guarda el resumen de la conversación y actualiza el perfil del usuario en una sola llamada.
+        
+        Usa la función RPC close_conversation (ver docs/deployment.md), que ejecuta
+        ambas escrituras en la misma transacción.
+        
+        Args:
+            conversation_id: ID único de la conversación
+            user_identifier: ID del usuario
+            summary: Resumen de la conversación
+            start_time: Hora de inicio de la conversación
+            end_time: Hora de finalización de la conversación
+            message_count: Número de mensajes en la conversación
+            profile_patch: Datos del perfil a actualizar (opcional)
+            
+        Returns:
+            True si se guardó correctamente, False en caso contrario
+        """
+        if not self.is_connected():
+            return False
+            
+        try:
+            response = await self.client.post(
+                "/rpc/close_conversation",
+                content=orjson.dumps({
+                    "p_conv": {
+                        "conversation_id": conversation_id,
+                        "user_identifier": user_identifier,
+                        "start_time": start_time,
+                        "end_time": end_time,
+                        "summary": summary,
+                        "message_count": message_count
+                    },
+                    "p_profile_patch": profile_patch or {}
+                }),
+            )
+            response.raise_for_status()
+            if profile_patch:
+                self._profile_cache.pop(user_identifier, None)
             return True
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                logger.warning("Error al cerrar conversación: %s", e)
+                return False
+            # La función RPC no está instalada: hacer ambas escrituras por separado
+            logger.info("Función close_conversation no disponible; se guardan resumen y perfil por separado")
         except Exception as e:
-            print(f"⚠️ Error al guardar resumen: {str(e)}")
+            logger.warning("Error al cerrar conversación: %s", e)
             return False
+        
+        return await self.finalize_conversation(
+            conversation_id=conversation_id,
+            user_identifier=user_identifier,
+            summary=summary,
+            start_time=start_time,
+            end_time=end_time,
+            message_count=message_count,
+            profile_patch=profile_patch
+        )
+    
+    async def finalize_conversation(self,
+                                    conversation_id: str,
+                                    user_identifier: str,
+                                    summary: str,
+                                    start_time: str,
+                                    end_time: str,
+                                    message_count: int,
+                                    profile_patch: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Guarda el resumen y actualiza el perfil del usuario de forma concurrente.
+        
+        La latencia total es la de la escritura más lenta y no la suma de ambas.
+        
+        Args:
+            conversation_id: ID único de la conversación
+            user_identifier: ID del usuario
+            summary: Resumen de la conversación
+            start_time: Hora de inicio de la conversación
+            end_time: Hora de finalización de la conversación
+            message_count: Número de mensajes en la conversación
+            profile_patch: Datos del perfil a actualizar (opcional)
+            
+        Returns:
+            True si todas las escrituras se guardaron correctamente, False en caso contrario
+        """
+        writes = {
+            "resumen": self.save_conversation_summary(
+                conversation_id=conversation_id,
+                user_identifier=user_identifier,
+                summary=summary,
+                start_time=start_time,
+                end_time=end_time,
+                message_count=message_count
+            )
+        }
+        if profile_patch:
+            writes["perfil"] = self.update_user_profile(user_identifier, profile_patch)
+        
+        results = await asyncio.gather(*writes.values(), return_exceptions=True)
+        
+        # Registrar cada fallo por separado
+        all_saved = True
+        for name, result in zip(writes, results):
+            if result is not True:
+                all_saved = False
+                logger.warning("No se pudo guardar %s al finalizar la conversación: %s", name, result)
+        return all_saved
     
-    async def get_recent_conversations(self, user_identifier: str, limit: int = 5) -> List[Dict[str, Any]]:
+    async def get_recent_conversations(self,
+                                       user_identifier: str,
+                                       limit: int = 5,
+                                       before_end_time: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         Obtiene las conversaciones recientes de un usuario.
         
+        Se pagina por cursor sobre end_time (índice (user_identifier, end_time DESC))
+        en lugar de OFFSET, para que las páginas profundas no recorran las anteriores.
+        
         Args:
             user_identifier: ID del usuario
             limit: Número máximo de conversaciones a obtener
+            before_end_time: end_time de la última conversación de la página anterior (opcional)
             
         Returns:
             Lista de conversaciones recientes
@@ -180,17 +587,46 @@ class SupabaseService:
             
         try:
             # Buscar conversaciones recientes del usuario
-            response = self.client.table("conversation_summaries") \
-                .select("*") \
-                .eq("user_identifier", user_identifier) \
-                .order("end_time", desc=True) \
-                .limit(limit) \
-                .execute()
-                
-            return response.data if response.data else []
+            params = {
+                "select": _SUMMARY_COLUMNS,
+                "user_identifier": f"eq.{user_identifier}",
+                "order": "end_time.desc",
+                "limit": limit,
+            }
+            if before_end_time:
+                params["end_time"] = f"lt.{before_end_time}"
+            
+            response = await self.client.get("/conversation_summaries", params=params)
+            response.raise_for_status()
+            
+            return orjson.loads(response.content) or []
         except Exception as e:
-            print(f"⚠️ Error al obtener conversaciones recientes: {str(e)}")
+            logger.warning("Error al obtener conversaciones recientes: %s", e)
             return []
             
-# Instancia global del servicio
-supabase_service = SupabaseService() 
\ No newline at end of file
+# Instancia del servicio por proceso, creada al arrancar cada worker (no al importar el módulo)
+_supabase_service: Optional[SupabaseService] = None
+
+def get_supabase_service() -> SupabaseService:
+    """
+    Obtiene el servicio de Supabase del proceso, creándolo si no existe.
+    
+    Returns:
+        Instancia compartida de SupabaseService
+    """
+    global _supabase_service
+    if _supabase_service is None:
+        _supabase_service = SupabaseService()
+    return _supabase_service
+
+def start_supabase_service() -> None:
+    """Crea el servicio del worker e inicia su verificación de salud."""
+    get_supabase_service().start_health_check()
+
+async def close_supabase_service() -> None:
+    """Cierra el servicio de Supabase si fue creado."""
+    global _supabase_service
+    if _supabase_service is not None:
+        await _supabase_service.close()
+        _supabase_service = None
+ 
\ No newline at end of file
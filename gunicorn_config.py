@@ -6,12 +6,10 @@ import os
 import multiprocessing
 
 # Número de workers (procesos)
-# Recomendación: 2*núcleos+1 para balance entre rendimiento y uso de recursos
-workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
-
-# Número de threads por worker
-# Útil para operaciones con I/O intensivo
-threads = int(os.getenv("GUNICORN_THREADS", "4"))
+# Un UvicornWorker por núcleo: cada uno ejecuta su propio event loop, por lo que
+# la fórmula 2*núcleos+1 (pensada para workers síncronos) solo añade cambios de contexto.
+# UvicornWorker ignora "threads", así que no se configura.
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
 
 # Timeout en segundos
 # Tiempo máximo permitido para que un worker procese una solicitud
@@ -24,9 +22,6 @@ bind = os.getenv("GUNICORN_BIND", f"{os.getenv('WEBHOOK_HOST', '0.0.0.0')}:{os.g
 # UvicornWorker es específico para FastAPI/ASGI
 worker_class = "uvicorn.workers.UvicornWorker"
 
-# Tipo de worker
-worker_type = "async"
-
 # Configuración de logging
 loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
 accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")  # "-" significa stdout
@@ -35,9 +30,20 @@ errorlog = os.getenv("GUNICORN_ERROR_LOG", "-")    # "-" significa stderr
 # Configuración de recarga automática (solo para desarrollo)
 reload = os.getenv("ENVIRONMENT", "production").lower() == "development"
 
+# Cargar la aplicación antes de crear los workers para compartir memoria (copy-on-write).
+# El recargador de Gunicorn no funciona con la aplicación precargada, así que en desarrollo
+# cada worker la importa por su cuenta.
+# No hace falta reiniciar nada tras el fork: ningún cliente de red abre conexiones al importar.
+# El servicio de Supabase y el hilo de logging se crean en el evento startup de cada worker,
+# la sesión de Cal.com en la primera solicitud, y el cliente de Redis de routes.py, aunque se
+# construye al importar, no conecta hasta su primer comando (ya dentro del worker).
+preload_app = not reload
+
 # Configuraciones adicionales
-keepalive = 65  # Tiempo en segundos para mantener conexiones abiertas
-worker_connections = 1000  # Número máximo de conexiones simultáneas
+keepalive = 65  # Tiempo en segundos para mantener conexiones abiertas (UvicornWorker lo usa como timeout_keep_alive)
+backlog = 2048  # Conexiones pendientes en cola del socket compartido
+# worker_connections solo aplica a workers gevent/eventlet; UvicornWorker lo ignora.
+# Para limitar solicitudes simultáneas usar Uvicorn directamente con --limit-concurrency (ver Dockerfile).
 max_requests = 1000  # Reiniciar worker después de procesar este número de solicitudes
 max_requests_jitter = 50  # Añadir variación aleatoria al max_requests
 
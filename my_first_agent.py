@@ -2,20 +2,24 @@ from agents.tool import function_tool
 import aiohttp
 import os
 import json
+import orjson
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import asyncio
+import threading
 from agents import Agent, Runner
-from typing import List, Dict, Optional, Union, Any, Tuple, TypedDict, Callable
+from typing import List, Dict, Optional, Union, Any, Tuple, TypedDict, Callable, NamedTuple, Iterable
 import re
-from dateutil.relativedelta import relativedelta
-import calendar
+import traceback
 import pytz
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import deque
+import heapq
+from itertools import islice
+from operator import itemgetter
 from enum import Enum, auto
 # Importaciones para la base de datos
 import uuid
-from supabase import create_client, Client
 from datetime import datetime, timezone
 
 # Carga explícita del archivo .env
@@ -41,7 +45,83 @@ TIMEZONE_MAP = {
 # Configuración por defecto
 DEFAULT_TIMEZONE = TimeZones.MEXICO
 
-# Clase para slots disponibles
+# Los tracebacks completos solo se muestran en desarrollo (mismo valor por defecto que start_server.py)
+_SHOW_TRACEBACKS = os.getenv("ENVIRONMENT", "development").lower() == "development"
+
+# Patrones precompilados para interpretar fechas en lenguaje natural
+_RE_DIA_MES = re.compile(r'(\d+)\s+de\s+(\w+)')
+_RE_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+# "pasado mañana" va antes que "mañana" en la alternancia para que tenga prioridad
+_RE_REL = re.compile(r'\b(pasado\s+ma[nñ]ana|ma[nñ]ana|hoy)\b')
+_RE_SIETE_DIAS = re.compile(r'7 d[ií]as')
+_RE_DIAS = re.compile(r'\b(lunes|martes|mi[eé]rcoles|jueves|viernes|s[aá]bado|domingo)\b')
+
+# Patrones precompilados para extraer datos del usuario de sus mensajes
+_USER_DATA_PATTERNS = (
+    ("name", re.compile(r"(?:me\s+llamo|soy|nombre\s+es)\s+([A-Za-zÀ-ÿ\s]+)(?:\.|,|\s|$)")),
+    ("email", re.compile(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")),
+    ("phone", re.compile(r"(?:\+\d{1,3}[\s-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}"))
+)
+
+# Selección de una opción por número: "opción 2" en cualquier parte o un número al inicio
+# (no coincide con dígitos sueltos más adelante, como los de un teléfono)
+_RE_OPTION = re.compile(r'(?:^|\bopci[oó]n\s+)(\d+)\b')
+
+# Configuración de Cal.com: se lee del entorno una sola vez al importar (tras load_dotenv)
+_CALCOM_API_KEY = os.getenv("CALCOM_API_KEY")
+_CALCOM_EVENT_TYPE_ID = os.getenv("CALCOM_EVENT_TYPE_ID")
+_CALCOM_USERNAME = os.getenv("CALCOM_USERNAME")
+_CALCOM_USEREMAIL = os.getenv("CALCOM_USEREMAIL")
+
+# Variables faltantes para cada herramienta (se reportan en cada llamada, como antes)
+_SLOTS_MISSING_VARS = [name for name, value in
+                       [("CALCOM_API_KEY", _CALCOM_API_KEY),
+                        ("CALCOM_EVENT_TYPE_ID", _CALCOM_EVENT_TYPE_ID),
+                        ("CALCOM_USERNAME", _CALCOM_USERNAME)]
+                       if not value]
+_BOOKING_MISSING_VARS = _SLOTS_MISSING_VARS + (["CALCOM_USEREMAIL"] if not _CALCOM_USEREMAIL else [])
+
+# La API de reservas espera el ID del tipo de evento como entero; un valor no numérico es un
+# error de configuración y se informa al arrancar indicando la variable afectada
+_CALCOM_EVENT_TYPE_ID_INT: Optional[int] = None
+if _CALCOM_EVENT_TYPE_ID:
+    try:
+        _CALCOM_EVENT_TYPE_ID_INT = int(_CALCOM_EVENT_TYPE_ID)
+    except ValueError:
+        raise ValueError(
+            f"CALCOM_EVENT_TYPE_ID debe ser un número entero (valor actual: {_CALCOM_EVENT_TYPE_ID!r})"
+        ) from None
+
+# Parte fija de las solicitudes; en cada llamada solo se añaden los campos dinámicos
+_SLOTS_URL = "https://api.cal.com/v1/slots"
+_SLOTS_PARAMS_BASE = {
+    "apiKey": _CALCOM_API_KEY,
+    "eventTypeId": _CALCOM_EVENT_TYPE_ID,
+    "timeZone": TIMEZONE_MAP[DEFAULT_TIMEZONE]
+}
+_BOOKING_URL = f"https://api.cal.com/v1/bookings?apiKey={_CALCOM_API_KEY}"
+_BOOKING_HEADERS = {"Content-Type": "application/json"}
+_BOOKING_PAYLOAD_BASE = {
+    "eventTypeId": _CALCOM_EVENT_TYPE_ID_INT,
+    "username": _CALCOM_USERNAME,
+    "useremail": _CALCOM_USEREMAIL,
+    "tittle": "Reserva de Experiencia Turística",  # Adaptado para turismo
+    "timeZone": TIMEZONE_MAP[DEFAULT_TIMEZONE],
+    "language": "es"
+}
+
+# Sesión HTTP compartida por todas las llamadas a Cal.com (se crea en la primera solicitud)
+# Reutiliza conexiones keep-alive y resolución DNS en lugar de abrir una sesión por llamada
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+# Slot interno: tupla con nombre, más compacta que un dict y sin hashing de claves
+class Slot(NamedTuple):
+    date: str
+    start_time: str
+    iso_time: str
+    formatted: str
+
+# Clase para slots disponibles (forma serializada que devuelve la herramienta)
 class AvailableSlot(TypedDict):
     date: str
     start_time: str
@@ -72,7 +152,34 @@ class BookingResult(TypedDict):
     message: str
     meeting_url: str  # Campo añadido para la URL de reunión
 
+# Nombres de días y meses en español (índice 0 = Lunes; los meses empiezan en 1)
+_DAY_NAMES = ("Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo")
+_MONTH_NAMES = ("", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+                "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre")
+
+# Inserción del historial por el pool de Postgres (mismas columnas que el cliente de Supabase)
+_HISTORY_INSERT_SQL = (
+    "INSERT INTO conversation_history "
+    "(conversation_id, user_identifier, timestamp, user_message, agent_response, metadata) "
+    "VALUES ($1, $2, $3::text::timestamptz, $4, $5, $6::jsonb)"
+)
+
+# Tamaño máximo del historial reciente y cada cuántos elementos expulsados se resumen
+MAX_HISTORY_ITEMS = 20
+SUMMARY_EVERY = 10
+
+# Turnos por lote de historial y segundos máximos que un turno espera a ser escrito
+HISTORY_BATCH_SIZE = 5
+HISTORY_FLUSH_INTERVAL = 10.0
+
+# Proyección (fecha, hora) de un slot serializado para el contexto del agente
+_slot_date_time = itemgetter("date", "start_time")
+
+# Comandos para salir
+_EXIT_COMMANDS = frozenset({'salir', 'exit', 'quit', 'adios', 'adiós', 'hasta luego', 'bye', 'byebye', 'chao', 'chaochao'})
+
 # Funciones auxiliares
+@lru_cache(maxsize=None)
 def get_timezone_instance(tz: TimeZones = DEFAULT_TIMEZONE) -> pytz.timezone:
     """
     Obtiene la instancia de zona horaria basada en la enumeración.
@@ -81,7 +188,7 @@ def get_timezone_instance(tz: TimeZones = DEFAULT_TIMEZONE) -> pytz.timezone:
         tz: La zona horaria a utilizar (de la enumeración TimeZones)
         
     Returns:
-        Instancia de pytz.timezone para la zona horaria solicitada
+        Instancia de pytz.timezone para la zona horaria solicitada (cacheada por zona)
     """
     return pytz.timezone(TIMEZONE_MAP[tz])
 
@@ -96,18 +203,113 @@ def format_date_human_readable(date_obj: datetime, include_year: bool = True) ->
     Returns:
         Cadena formateada con la fecha en español
     """
-    day_names = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
-    month_names = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", 
-                    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-    
-    day_name = day_names[date_obj.weekday()]
+    day_name = _DAY_NAMES[date_obj.weekday()]
     day = date_obj.day
-    month = month_names[date_obj.month]
+    month = _MONTH_NAMES[date_obj.month]
     
     if include_year:
         return f"{day_name} {day} de {month} de {date_obj.year}"
     return f"{day_name} {day} de {month}"
 
+def _append_history(history: deque, items: Iterable[Any], evicted: List[Any]) -> None:
+    """
+    Añade elementos al historial acotado, guardando los que salen por la izquierda.
+    
+    Args:
+        history: Historial reciente con maxlen
+        items: Elementos nuevos a añadir
+        evicted: Lista donde se acumulan los elementos expulsados
+    """
+    for item in items:
+        if len(history) == history.maxlen:
+            evicted.append(history.popleft())
+        history.append(item)
+    
+    # Una salida de herramienta sin su llamada previa no es una entrada válida para el modelo
+    while history and isinstance(history[0], dict) and history[0].get("type") == "function_call_output":
+        evicted.append(history.popleft())
+
+async def _sb(call: Callable[[], Any]) -> Any:
+    """
+    Ejecuta una llamada síncrona del cliente de Supabase en un hilo aparte.
+    
+    Args:
+        call: Función sin argumentos a ejecutar (normalmente el .execute de una consulta)
+        
+    Returns:
+        Resultado de la llamada
+    """
+    return await asyncio.to_thread(call)
+
+def _resolve_input(future: asyncio.Future, line: Optional[str], error: Optional[BaseException]) -> None:
+    """Entrega al event loop el resultado de la lectura, si alguien sigue esperándolo."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(line)
+
+async def _read_line(prompt: str) -> str:
+    """
+    Lee una línea de la entrada estándar sin bloquear el event loop.
+    
+    input() corre en un hilo daemon y no en el executor por defecto: si la conversación
+    termina mientras se espera una línea, asyncio.run no queda esperando a ese hilo.
+    
+    Args:
+        prompt: Texto a mostrar antes de leer
+        
+    Returns:
+        Línea introducida por el usuario (EOFError/KeyboardInterrupt se propagan)
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def reader() -> None:
+        try:
+            line, error = input(prompt), None
+        except BaseException as e:
+            line, error = None, e
+        try:
+            loop.call_soon_threadsafe(_resolve_input, future, line, error)
+        except RuntimeError:
+            # El event loop ya se cerró: nadie espera la línea
+            pass
+    
+    threading.Thread(target=reader, daemon=True).start()
+    return await future
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Obtiene la sesión HTTP compartida, creándola si no existe.
+    
+    Returns:
+        Sesión de aiohttp con pool de conexiones keep-alive
+    """
+    global _SESSION
+    # La creación no contiene awaits, así que no hay carreras entre corrutinas
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=30),
+            # Serializar los cuerpos JSON con orjson
+            json_serialize=lambda obj: orjson.dumps(obj).decode()
+        )
+    return _SESSION
+
+async def close_session() -> None:
+    """Cierra la sesión HTTP compartida si está abierta."""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
 async def api_request(
     method: str, 
     url: str, 
@@ -128,50 +330,53 @@ async def api_request(
     Returns:
         Tupla con (código_respuesta, datos_json)
     """
-    async with aiohttp.ClientSession() as session:
-        method_func = getattr(session, method.lower())
-        
-        kwargs = {}
-        if params:
-            kwargs['params'] = params
-        if headers:
-            kwargs['headers'] = headers
-        if data:
-            kwargs['data'] = json.dumps(data)
+    session = await get_session()
+    async with session.request(method.upper(), url, params=params, headers=headers, json=data) as response:
+        # Decodificar el cuerpo con orjson; si no es JSON se devuelve como texto
+        response_bytes = await response.read()
+        try:
+            response_data = orjson.loads(response_bytes)
+        except orjson.JSONDecodeError:
+            response_data = {"text": response_bytes.decode(response.get_encoding(), errors="replace")}
             
-        async with method_func(url, **kwargs) as response:
-            try:
-                response_data = await response.json()
-            except:
-                response_text = await response.text()
-                response_data = {"text": response_text}
-                
-            return response.status, response_data
+        return response.status, response_data
 
-def parse_natural_date(
-    date_expression: Optional[str], 
-    today: datetime, 
-    tz: pytz.timezone
-) -> Tuple[datetime, datetime]:
+# Días por mes (índice 0 sin uso; febrero en año no bisiesto)
+_DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def _days_in_month(year: int, month: int) -> int:
     """
-    Interpreta una expresión de fecha en lenguaje natural.
+    Devuelve el número de días de un mes sin pasar por calendar.monthrange.
     
     Args:
-        date_expression: Expresión de fecha en lenguaje natural
-        today: Fecha actual
-        tz: Zona horaria
+        year: Año
+        month: Mes (1-12)
         
     Returns:
-        Tupla de (fecha_inicio, fecha_fin)
+        Número de días del mes
     """
-    # Valores predeterminados
-    start_time = today + timedelta(days=1)  # Mañana por defecto
-    end_time = start_time + timedelta(days=7)  # Una semana después por defecto
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+    return _DAYS_IN_MONTH[month]
+
+@lru_cache(maxsize=256)
+def _interpret_date_expression(date_expression: str, today_date: date) -> Tuple[Optional[int], Optional[date], bool]:
+    """
+    Interpreta una expresión de fecha ya normalizada (en minúsculas y sin espacios extremos).
     
-    if not date_expression:
-        return start_time, end_time
+    El resultado solo depende de la expresión y de la fecha actual, así que se cachea:
+    las expresiones repetidas ("mañana", "lunes") no vuelven a pasar por las regex.
+    
+    Args:
+        date_expression: Expresión de fecha normalizada
+        today_date: Fecha actual (sin hora)
         
-    date_expression = date_expression.lower().strip()
+    Returns:
+        Tupla de (días a sumar a hoy o None, fecha absoluta o None, si el rango es de un mes)
+    """
+    # Mañana por defecto
+    offset: Optional[int] = 1
+    fecha: Optional[date] = None
     
     # Mapeo de nombres de días en español a números (0=Lunes, 6=Domingo)
     dias = {
@@ -185,29 +390,30 @@ def parse_natural_date(
         'julio': 7, 'agosto': 8, 'septiembre': 9, 'octubre': 10, 'noviembre': 11, 'diciembre': 12
     }
     
-    # Caso 1: Expresiones relativas simples
-    if "hoy" in date_expression:
-        start_time = today
-    elif any(expr in date_expression for expr in ["mañana", "manana"]):
-        start_time = today + timedelta(days=1)
-    elif any(expr in date_expression for expr in ["pasado mañana", "pasado manana"]):
-        start_time = today + timedelta(days=2)
+    # Los casos se evalúan por frecuencia: relativas y días de la semana (lo que sugiere
+    # el propio agente) antes que fechas numéricas; el formato ISO es el menos común
+    
+    # Caso 1: Expresiones relativas simples (una sola búsqueda para hoy/mañana/pasado mañana)
+    if (match := _RE_REL.search(date_expression)):
+        relativa = match.group(1)
+        if relativa == "hoy":
+            offset = 0
+        elif relativa.startswith("pasado"):
+            offset = 2
+        else:
+            offset = 1
     
     # Caso 2: Próximo día de la semana (ej. "lunes próximo")
-    elif any(dia in date_expression for dia in dias.keys()):
-        # Encontrar qué día de la semana se mencionó
-        dia_mencionado = next((dia for dia in dias.keys() if dia in date_expression), None)
-        
-        if dia_mencionado:
-            dia_objetivo = dias[dia_mencionado]
-            dias_para_sumar = (dia_objetivo - today.weekday()) % 7
-            if dias_para_sumar == 0:  # Si es hoy, vamos a la próxima semana
-                dias_para_sumar = 7
-            start_time = today + timedelta(days=dias_para_sumar)
+    elif (match := _RE_DIAS.search(date_expression)):
+        # La coincidencia es directamente una clave del mapeo (con o sin acento)
+        dia_objetivo = dias[match.group(1)]
+        dias_para_sumar = (dia_objetivo - today_date.weekday()) % 7
+        if dias_para_sumar == 0:  # Si es hoy, vamos a la próxima semana
+            dias_para_sumar = 7
+        offset = dias_para_sumar
     
     # Caso 3: Fecha específica (ej. "31 de marzo")
-    elif re.search(r'(\d+)\s+de\s+(\w+)', date_expression):
-        match = re.search(r'(\d+)\s+de\s+(\w+)', date_expression)
+    elif (match := _RE_DIA_MES.search(date_expression)):
         dia = int(match.group(1))
         mes_str = match.group(2).lower()
         
@@ -215,82 +421,134 @@ def parse_natural_date(
             mes = meses[mes_str]
             
             # Determinar el año (este año o el próximo)
-            anio = today.year
+            anio = today_date.year
             # Si la fecha ya pasó este año, usamos el próximo año
-            if mes < today.month or (mes == today.month and dia < today.day):
+            if mes < today_date.month or (mes == today_date.month and dia < today_date.day):
                 anio += 1
             
-            # Validar que la fecha sea válida
-            try:
-                dias_en_mes = calendar.monthrange(anio, mes)[1]
-                if 1 <= dia <= dias_en_mes:
-                    # Crear datetime sin timezone y luego localizarlo
-                    naive_dt = datetime(anio, mes, dia)
-                    start_time = tz.localize(naive_dt)
-            except ValueError:
-                pass  # Si hay error, mantenemos el valor predeterminado
+            # Validar que la fecha sea válida; si no, mantenemos el valor predeterminado
+            if 1 <= dia <= _days_in_month(anio, mes):
+                offset, fecha = None, date(anio, mes, dia)
     
     # Caso 4: Fecha con formato estándar (YYYY-MM-DD)
-    elif re.match(r'^\d{4}-\d{2}-\d{2}$', date_expression):
+    elif _RE_ISO_DATE.match(date_expression):
         try:
-            # Crear datetime sin timezone y luego localizarlo
-            naive_dt = datetime.strptime(date_expression, "%Y-%m-%d")
-            start_time = tz.localize(naive_dt)
+            offset, fecha = None, datetime.strptime(date_expression, "%Y-%m-%d").date()
         except ValueError:
             pass  # Si hay error, mantenemos el valor predeterminado
     
-    # Buscar indicadores de rango de fechas para determinar la fecha de fin
-    if "semana" in date_expression or "7 días" in date_expression or "7 dias" in date_expression:
-        end_time = start_time + timedelta(days=7)
-    elif "mes" in date_expression:
+    # Buscar indicadores de rango de fechas para determinar la fecha de fin.
+    # Solo "mes" cambia el rango: "semana", "7 días" y el caso por defecto usan 7 días
+    monthly = "mes" in date_expression and "semana" not in date_expression and not _RE_SIETE_DIAS.search(date_expression)
+    
+    return offset, fecha, monthly
+
+def parse_natural_date(
+    date_expression: Optional[str], 
+    today: datetime, 
+    tz: pytz.timezone
+) -> Tuple[datetime, datetime]:
+    """
+    Interpreta una expresión de fecha en lenguaje natural.
+    
+    Args:
+        date_expression: Expresión de fecha en lenguaje natural
+        today: Fecha actual
+        tz: Zona horaria
+        
+    Returns:
+        Tupla de (fecha_inicio, fecha_fin)
+    """
+    # Valores predeterminados
+    start_time = today + timedelta(days=1)  # Mañana por defecto
+    end_time = start_time + timedelta(days=7)  # Una semana después por defecto
+    
+    if not date_expression:
+        return start_time, end_time
+    
+    # La interpretación cacheada se aplica sobre la hora actual y la zona horaria
+    offset, fecha, monthly = _interpret_date_expression(date_expression.lower().strip(), today.date())
+    if fecha is None:
+        start_time = today + timedelta(days=offset)
+    else:
+        # Crear datetime sin timezone y luego localizarlo
+        start_time = tz.localize(datetime(fecha.year, fecha.month, fecha.day))
+    
+    if monthly:
+        # dateutil solo se importa cuando se pide un rango mensual
+        from dateutil.relativedelta import relativedelta
         end_time = start_time + relativedelta(months=1)
     else:
-        # Por defecto, usamos un rango de 7 días
         end_time = start_time + timedelta(days=7)
         
     return start_time, end_time
 
-def format_time_slots(
-    slots_by_date: Dict[str, List[Dict[str, Any]]],
-    max_days: int = 3,
-    max_slots_per_day: int = 3
-) -> List[AvailableSlot]:
+def _parse_slots(data_slots: Dict[str, List[Dict[str, Any]]]) -> Dict[str, List[Slot]]:
     """
-    Formatea y limita los slots disponibles.
+    Convierte los slots de Cal.com en slots formateados agrupados por fecha.
+    
+    Cal.com devuelve ISO-8601 (YYYY-MM-DDTHH:MM:SS±HH:MM) en la zona solicitada,
+    así que la hora se toma directamente del texto sin construir un datetime.
+    Los slots sin hora o con un formato inesperado se omiten.
     
     Args:
-        slots_by_date: Diccionario de slots agrupados por fecha
-        max_days: Número máximo de días a incluir
-        max_slots_per_day: Número máximo de slots por día
+        data_slots: Diccionario de slots por fecha tal como lo devuelve la API
         
     Returns:
-        Lista de slots formateados y limitados
+        Diccionario de slots formateados por fecha (sin días vacíos)
     """
-    formatted_slots = []
-    
-    # Tomar hasta max_days días con hasta max_slots_per_day slots cada uno
-    for date, slots in sorted(slots_by_date.items())[:max_days]:
-        formatted_slots.extend(slots[:max_slots_per_day])
-    
-    # Limitar al máximo total (max_days * max_slots_per_day)
-    return formatted_slots[:max_days * max_slots_per_day]
+    slots_by_date = {
+        day: [
+            # start_time y formatted comparten el mismo HH:MM recortado una sola vez
+            Slot(day, (hhmm := t[11:16]), t, hhmm)
+            for t in (slot.get("time") for slot in slots)
+            if t and len(t) >= 16 and t[10] == "T"
+        ]
+        for day, slots in data_slots.items()
+    }
+    return {day: day_slots for day, day_slots in slots_by_date.items() if day_slots}
 
-def create_readable_slots(formatted_slots: List[AvailableSlot], emoji: str = "🕓") -> List[str]:
+def _build_slot_output(
+    slots_by_date: Dict[str, List[Slot]],
+    max_days: int = 3,
+    max_slots_per_day: int = 3,
+    emoji: str = "🕓"
+) -> Tuple[List[Slot], List[str]]:
     """
-    Crea representaciones legibles de los slots disponibles.
+    Limita los slots disponibles y crea sus representaciones legibles en una sola pasada.
     
     Args:
-        formatted_slots: Lista de slots formateados
+        slots_by_date: Diccionario de slots agrupados por fecha
+        max_days: Número máximo de días a incluir
+        max_slots_per_day: Número máximo de slots por día
         emoji: Emoji a usar para cada opción
         
     Returns:
-        Lista de cadenas legibles con formato atractivo
+        Tupla con (slots formateados y limitados, cadenas legibles con formato atractivo)
     """
-    return [
-        f"{emoji} *Opción {i+1}:* {format_date_human_readable(datetime.strptime(slot['date'], '%Y-%m-%d'))} "
-        f"a las *{slot['start_time']}* hrs"
-        for i, slot in enumerate(formatted_slots)
-    ]
+    formatted_slots: List[Slot] = []
+    readable_slots: List[str] = []
+    
+    # Cal.com suele devolver las fechas en orden cronológico (y el dict conserva el orden
+    # de inserción); si ya vienen ordenadas basta con tomar las primeras sin ordenar
+    days = list(slots_by_date)
+    if all(a < b for a, b in zip(days, days[1:])):
+        selected_days = islice(slots_by_date.items(), max_days)
+    else:
+        selected_days = heapq.nsmallest(max_days, slots_by_date.items(), key=itemgetter(0))
+    
+    # Tomar las primeras max_days fechas con hasta max_slots_per_day slots cada una;
+    # la fecha legible se calcula una vez por día
+    for day, slots in selected_days:
+        readable_date = format_date_human_readable(datetime.fromisoformat(day))
+        for slot in slots[:max_slots_per_day]:
+            formatted_slots.append(slot)
+            readable_slots.append(
+                f"{emoji} *Opción {len(formatted_slots)}:* {readable_date} "
+                f"a las *{slot.start_time}* hrs"
+            )
+    
+    return formatted_slots, readable_slots
 
 # Decorador para manejo de errores en herramientas
 def handle_tool_errors(func):
@@ -318,19 +576,9 @@ async def get_slots(date_expression: str = None) -> Union[SlotsResult, ErrorResu
     Returns:
         Los slots disponibles formateados para mostrar al usuario
     """
-    # Obtener credenciales y configuración
-    api_key = os.getenv("CALCOM_API_KEY")
-    event_type_id = os.getenv("CALCOM_EVENT_TYPE_ID")
-    username = os.getenv("CALCOM_USERNAME")
-
     # Validar credenciales
-    if not all([api_key, event_type_id, username]):
-        missing_vars = [var for var, val in 
-                        [("CALCOM_API_KEY", api_key), 
-                         ("CALCOM_EVENT_TYPE_ID", event_type_id),
-                         ("CALCOM_USERNAME", username)] 
-                        if not val]
-        return {"error": f"Faltan variables de entorno: {', '.join(missing_vars)}"}
+    if _SLOTS_MISSING_VARS:
+        return {"error": f"Faltan variables de entorno: {', '.join(_SLOTS_MISSING_VARS)}"}
 
     # Configurar zona horaria y fecha actual
     mexico_tz = get_timezone_instance(TimeZones.MEXICO)
@@ -340,67 +588,24 @@ async def get_slots(date_expression: str = None) -> Union[SlotsResult, ErrorResu
     start_time, end_time = parse_natural_date(date_expression, today, mexico_tz)
     
     # Configurar parámetros para la API
-    url = "https://api.cal.com/v1/slots"
     params = {
-        "apiKey": api_key,
-        "eventTypeId": event_type_id,
+        **_SLOTS_PARAMS_BASE,
         "startTime": start_time.strftime("%Y-%m-%d"),
-        "endTime": end_time.strftime("%Y-%m-%d"),
-        "timeZone": TIMEZONE_MAP[DEFAULT_TIMEZONE]
+        "endTime": end_time.strftime("%Y-%m-%d")
     }
 
     # Realizar solicitud a la API
-    status_code, data = await api_request("get", url, params=params)
+    status_code, data = await api_request("get", _SLOTS_URL, params=params)
     
     if status_code != 200:
         error_details = data.get("text", str(data)) if isinstance(data, dict) else str(data)
         return {"error": f"Error al obtener disponibilidad: {status_code}", "details": error_details}
     
     # Procesar los slots disponibles
-    available_slots = []
-    slots_by_date = {}
-                    
-    # Extraer y procesar todos los slots disponibles
-    for day, slots in data.get("slots", {}).items():
-        day_slots = []
-        for slot in slots:
-            time_str = slot.get("time")
-            if not time_str:
-                continue
-                
-            # Convertir la hora a un formato estándar
-            try:
-                # Intentar diferentes formatos de hora
-                if '+' in time_str or '-' in time_str:
-                    time_dt = datetime.fromisoformat(time_str)
-                else:
-                    time_dt = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
-            except ValueError:
-                try:
-                    # Último intento con formato simple
-                    date_part = day
-                    time_part = time_str.split('T')[1] if 'T' in time_str else time_str
-                    time_dt = datetime.strptime(f"{date_part} {time_part.split('+')[0].split('-')[0]}", "%Y-%m-%d %H:%M:%S")
-                except:
-                    # Si falla, omitimos este slot
-                    continue
-            
-            # Añadir slot procesado
-            slot_info = {
-                "date": day,
-                "start_time": time_dt.strftime("%H:%M"),
-                "iso_time": time_str,
-                "formatted": time_dt.strftime("%H:%M")
-            }
-            
-            day_slots.append(slot_info)
-        
-        # Si hay slots para este día, los añadimos al diccionario
-        if day_slots:
-            slots_by_date[day] = day_slots
+    slots_by_date = _parse_slots(data.get("slots", {}))
     
-    # Formatear y limitar los slots
-    formatted_slots = format_time_slots(slots_by_date)
+    # Formatear y limitar los slots, creando a la vez los textos legibles para el usuario
+    formatted_slots, readable_slots = _build_slot_output(slots_by_date)
     
     # Si no hay slots disponibles después del procesamiento
     if not formatted_slots:
@@ -411,12 +616,10 @@ async def get_slots(date_expression: str = None) -> Union[SlotsResult, ErrorResu
             "date_to": end_time.strftime("%Y-%m-%d")
         }
     
-    # Crear slots legibles para el usuario
-    readable_slots = create_readable_slots(formatted_slots)
-    
     # Construir respuesta
     return {
-                        "available_slots": formatted_slots,
+        # Los slots se convierten a dict solo en la frontera de la herramienta
+        "available_slots": [slot._asdict() for slot in formatted_slots],
         "readable_slots": readable_slots,
         "total_slots": len(formatted_slots),
         "date_query": date_expression if date_expression else "próximos días",
@@ -448,23 +651,9 @@ async def schedule_appointment(
     Returns:
         Confirmation details of the scheduled appointment
     """
-    # Obtener credenciales y configuración
-    api_key = os.getenv("CALCOM_API_KEY")
-    event_type_id = os.getenv("CALCOM_EVENT_TYPE_ID")
-    username = os.getenv("CALCOM_USERNAME")
-    user_email = os.getenv("CALCOM_USEREMAIL")
-    
     # Validar credenciales
-    required_vars = {
-        "CALCOM_API_KEY": api_key,
-        "CALCOM_EVENT_TYPE_ID": event_type_id,
-        "CALCOM_USERNAME": username,
-        "CALCOM_USEREMAIL": user_email
-    }
-    
-    missing_vars = [name for name, value in required_vars.items() if not value]
-    if missing_vars:
-        return {"error": f"Faltan variables de entorno: {', '.join(missing_vars)}"}
+    if _BOOKING_MISSING_VARS:
+        return {"error": f"Faltan variables de entorno: {', '.join(_BOOKING_MISSING_VARS)}"}
     
     # Validar datos del usuario
     if not name or not email:
@@ -506,40 +695,32 @@ async def schedule_appointment(
     except ValueError:
         return {"error": "Formato de fecha u hora inválido. Use YYYY-MM-DD para fecha y HH:MM para hora."}
     
-    # Configurar la solicitud para la API
-    booking_url = f"https://api.cal.com/v1/bookings?apiKey={api_key}"
-    headers = {"Content-Type": "application/json"}
-    
     # Configurar payload según la estructura esperada por la API
     payload = {
-        "eventTypeId": int(event_type_id),
-        "username": username,
-        "useremail": user_email,
+        **_BOOKING_PAYLOAD_BASE,
         "start": start_iso,
         "end": end_iso,
         "responses": {
                 "name": name,
             "email": email
         },
-        "tittle": "Reserva de Experiencia Turística",  # Adaptado para turismo
         "metadata": {
             "source": "asistente_turismo",
             "notes": notes or ""
-        },
-        "timeZone": TIMEZONE_MAP[DEFAULT_TIMEZONE],
-        "language": "es"
+        }
     }
     
     # Realizar la solicitud a la API
-    status_code, booking_data = await api_request("post", booking_url, headers=headers, data=payload)
+    status_code, booking_data = await api_request("post", _BOOKING_URL, headers=_BOOKING_HEADERS, data=payload)
     
     # Procesar la respuesta
     if status_code in (200, 201):
         # Asegurar que booking_data es un diccionario
         if not isinstance(booking_data, dict):
             try:
-                booking_data = json.loads(booking_data)
-            except:
+                booking_data = orjson.loads(booking_data)
+            except (orjson.JSONDecodeError, TypeError):
+                # JSONDecodeError: texto no JSON; TypeError: tipo que no es str/bytes
                 booking_data = {"message": "Reserva exitosa pero respuesta no procesable"}
         
         # Formatear la fecha para mostrarla de forma amigable
@@ -656,13 +837,31 @@ async def main():
         supabase = None
     else:
         try:
-            # Inicializar el cliente de Supabase
+            # Inicializar el cliente de Supabase (se importa aquí: las herramientas no lo necesitan)
+            from supabase import create_client, Client
             supabase: Client = create_client(supabase_url, supabase_key)
             print("✅ Conexión a Supabase establecida correctamente.")
         except Exception as e:
             print(f"⚠️ Error al conectar con Supabase: {str(e)}")
             print("⚠️ El historial no será guardado.")
             supabase = None
+    
+    # Pool de conexiones directas a Postgres (opcional) para escribir el historial
+    # sin pasar por PostgREST; statement_cache_size=0 por compatibilidad con Supavisor
+    db_pool = None
+    pg_dsn = os.getenv("SUPABASE_PG_DSN")
+    if pg_dsn:
+        try:
+            import asyncpg
+            db_pool = await asyncpg.create_pool(
+                dsn=pg_dsn,
+                min_size=10,
+                max_size=50,
+                max_inactive_connection_lifetime=300,
+                statement_cache_size=0
+            )
+        except Exception as e:
+            print(f"⚠️ Error al crear el pool de Postgres: {str(e)}")
             
     print("¡Bienvenido! Soy su Concierge Virtual para experiencias turísticas en México. Escribe 'salir' para terminar la conversación.")
     
@@ -671,8 +870,19 @@ async def main():
     conversation_start_time = datetime.now(timezone.utc).isoformat()
     print(f"ID de sesión: {conversation_id}")
     
-    # Inicializamos una lista para el historial de conversación
-    conversation_history = []
+    # Contexto fijo de la sesión (perfil del usuario, resumen de la última conversación)
+    session_context = []
+    
+    # Historial reciente acotado (FIFO); lo que sale por la izquierda se resume cada
+    # SUMMARY_EVERY elementos en rolling_summary para no perder el contexto antiguo
+    conversation_history: deque = deque(maxlen=MAX_HISTORY_ITEMS)
+    evicted_items: List[Any] = []
+    rolling_summary = ""
+    turn_count = 0
+    
+    # Bloque dinámico con los slots vigentes: va al final de la entrada de cada turno y no se
+    # guarda en el historial, para que el prefijo estable se mantenga igual entre turnos
+    slots_context: Optional[Dict[str, str]] = None
     
     # Datos de usuario en caché (baja mutabilidad)
     user_profile = {}
@@ -680,9 +890,6 @@ async def main():
     # Para mantener los slots disponibles entre turnos
     available_slots_data = []
     
-    # Comandos para salir
-    exit_commands = {'salir', 'exit', 'quit', 'adios', 'adiós', 'hasta luego', 'bye', 'byebye', 'chao', 'chaochao'}
-    
     # Intentar cargar datos del usuario si el supabase está configurado
     if supabase:
         try:
@@ -691,7 +898,7 @@ async def main():
             
             if user_identifier:
                 # Buscar perfil del usuario en la tabla de perfiles
-                user_data = supabase.table("user_profiles").select("*").eq("identifier", user_identifier).execute()
+                user_data = await _sb(supabase.table("user_profiles").select("*").eq("identifier", user_identifier).execute)
                 
                 if user_data.data and len(user_data.data) > 0:
                     user_profile = user_data.data[0]
@@ -707,15 +914,15 @@ async def main():
                             f"- Preferencias: {user_profile.get('preferences', 'No disponible')}\n"
                         )
                     }
-                    conversation_history.append(user_context)
+                    session_context.append(user_context)
                 
                 # Cargar el historial de conversaciones recientes si existen
-                recent_history = supabase.table("conversation_history") \
-                    .select("*") \
-                    .eq("user_identifier", user_identifier) \
-                    .order("timestamp", desc=True) \
-                    .limit(1) \
-                    .execute()
+                recent_history = await _sb(supabase.table("conversation_history")
+                    .select("*")
+                    .eq("user_identifier", user_identifier)
+                    .order("timestamp", desc=True)
+                    .limit(1)
+                    .execute)
                 
                 if recent_history.data and len(recent_history.data) > 0:
                     last_conversation = recent_history.data[0]
@@ -724,162 +931,302 @@ async def main():
                     
                     # Si la última conversación fue hace menos de 24 horas, añadir un resumen al contexto
                     if (now - last_conversation_time).total_seconds() < 86400:  # 24 horas
-                        conversation_history.append({
+                        session_context.append({
                             "role": "system",
                             "content": f"Resumen de la última conversación: {last_conversation.get('summary', 'No disponible')}"
                         })
         except Exception as e:
             print(f"⚠️ Error al cargar datos de usuario: {str(e)}")
     
+    # Identificador del usuario resuelto una vez (los datos detectados nunca lo cambian)
+    profile_identifier = user_profile.get("identifier")
+    user_id = profile_identifier or "anonymous"
+    
+    # Cola de turnos pendientes de guardar: la conversación no espera a la base de datos
+    # y un escritor en segundo plano inserta los turnos acumulados en un solo lote.
+    # Un None en la cola fuerza a escribir el lote en curso sin esperar (ver flush_history)
+    history_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+    
+    # Inserción directa en PostgREST con el cuerpo ya serializado (sin pasar por supabase-py)
+    history_url = f"{supabase_url}/rest/v1/conversation_history"
+    history_headers = {
+        "apikey": supabase_key or "",
+        "Authorization": f"Bearer {supabase_key}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal"
+    }
+    
+    async def history_writer():
+        """Inserta en lotes los turnos encolados en la tabla de historial"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await history_queue.get()]
+            
+            # Acumular hasta HISTORY_BATCH_SIZE turnos o HISTORY_FLUSH_INTERVAL segundos
+            deadline = loop.time() + HISTORY_FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < HISTORY_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(history_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            rows = [row for row in batch if row is not None]
+            try:
+                # Guardar en la tabla de historial (un lote con solo el marcador no escribe nada)
+                if rows and db_pool:
+                    async with db_pool.acquire() as conn:
+                        await conn.executemany(_HISTORY_INSERT_SQL, rows)
+                elif rows:
+                    # Cada turno ya es JSON: el lote es solo unir los bytes en un array
+                    session = await get_session()
+                    async with session.post(history_url, data=b"[" + b",".join(rows) + b"]", headers=history_headers) as response:
+                        if response.status >= 300:
+                            raise RuntimeError(f"{response.status}: {await response.text()}")
+            except Exception as e:
+                print(f"⚠️ Error al guardar conversación: {str(e)}")
+                if _SHOW_TRACEBACKS:
+                    traceback.print_exc()
+            finally:
+                for _ in batch:
+                    history_queue.task_done()
+    
+    writer_task = asyncio.create_task(history_writer()) if supabase or db_pool else None
+    
     async def save_conversation_turn(user_message, agent_response):
-        """Guarda un turno de conversación en la base de datos vectorial"""
-        if not supabase:
+        """Encola un turno de conversación para guardarlo en la base de datos vectorial"""
+        if writer_task is None:
             return
             
-        try:
-            # Verificar si user_identifier existe
-            user_identifier = user_profile.get("identifier", "anonymous")
-            print(f"ID de usuario para guardar: {user_identifier}")
-            
-            # Datos para guardar
-            conversation_data = {
+        # Datos para guardar
+        timestamp = datetime.now(timezone.utc).isoformat()
+        metadata = {
+            "available_slots": len(available_slots_data),
+            "has_user_profile": bool(user_profile)
+        }
+        
+        # Serializar ahora, entre turnos, en la forma que usará el escritor: argumentos para
+        # executemany con el pool de Postgres o JSON (orjson) para el POST a PostgREST
+        if db_pool:
+            row = (conversation_id, user_id, timestamp, user_message, agent_response,
+                   orjson.dumps(metadata).decode())
+        else:
+            row = orjson.dumps({
                 "conversation_id": conversation_id,
-                "user_identifier": user_identifier,
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "user_identifier": user_id,
+                "timestamp": timestamp,
                 "user_message": user_message,
                 "agent_response": agent_response,
-                "metadata": {
-                    "available_slots": len(available_slots_data),
-                    "has_user_profile": bool(user_profile)
-                }
-            }
-            
-            print(f"Intentando guardar datos en conversation_history...")
-            # Guardar en la tabla de historial
-            response = supabase.table("conversation_history").insert(conversation_data).execute()
-            print(f"Respuesta de Supabase: {response}")
-        except Exception as e:
-            print(f"⚠️ Error al guardar conversación: {str(e)}")
-            import traceback
-            traceback.print_exc()
-    
-    # Ciclo principal de conversación
-    while True:
-        # Obtenemos el mensaje del usuario con prompt contextual
-        prompt = "¿Cómo puedo ayudarle hoy? " if not conversation_history else "¿En qué más puedo asistirle? "
-        message = input(prompt)
-        
-        # Verificamos si el usuario quiere salir
-        if message.lower() in exit_commands:
-            # Guardar resumen final de la conversación si supabase está disponible
-            if supabase:
-                try:
-                    # Crear un resumen de la conversación con el propio agente
-                    summary_input = [
-                        {"role": "system", "content": "Resume brevemente esta conversación en una sola frase."},
-                        *conversation_history[-10:]  # Usamos los últimos 10 mensajes para el resumen
-                    ]
-                    
-                    summary_result = await Runner.run(agent, summary_input)
-                    conversation_summary = summary_result.final_output
-                    
-                    # Guardar el resumen
-                    supabase.table("conversation_summaries").insert({
-                        "conversation_id": conversation_id,
-                        "user_identifier": user_profile.get("identifier", "anonymous"),
-                        "start_time": conversation_start_time,
-                        "end_time": datetime.now(timezone.utc).isoformat(),
-                        "summary": conversation_summary,
-                        "message_count": len(conversation_history) // 2  # Aproximado
-                    }).execute()
-                except Exception as e:
-                    print(f"⚠️ Error al guardar resumen: {str(e)}")
-            
-            print("¡Gracias por contactarnos! Esperamos darle la bienvenida pronto a nuestras experiencias. ¡Buen viaje!")
-            break
+                "metadata": metadata
+            })
         
         try:
-            # Ejecutamos el agente con el mensaje apropiado
-            result = await Runner.run(
-                agent, 
-                conversation_history + [{"role": "user", "content": message}] if conversation_history else message
-            )
-            
-            # Extraer datos potencialmente persistentes del mensaje del usuario
-            # Esto permite actualizar automáticamente información del usuario que no cambia frecuentemente
-            user_data_patterns = {
-                "name": r"(?:me\s+llamo|soy|nombre\s+es)\s+([A-Za-zÀ-ÿ\s]+)(?:\.|,|\s|$)",
-                "email": r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}",
-                "phone": r"(?:\+\d{1,3}[\s-]?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}"
-            }
-            
-            detected_user_data = {}
-            for key, pattern in user_data_patterns.items():
-                match = re.search(pattern, message)
-                if match and key == "name":
-                    detected_user_data[key] = match.group(1).strip()
-                elif match:
-                    detected_user_data[key] = match.group(0)
-            
-            # Actualizar la información del usuario en caché y potencialmente en BD
-            if detected_user_data and supabase and user_profile.get("identifier"):
-                user_profile.update(detected_user_data)
-                try:
-                    supabase.table("user_profiles").update(detected_user_data) \
-                        .eq("identifier", user_profile["identifier"]) \
-                        .execute()
-                except Exception as e:
-                    print(f"⚠️ Error al actualizar perfil: {str(e)}")
+            history_queue.put_nowait(row)
+        except asyncio.QueueFull:
+            print("⚠️ Cola de historial llena; el turno no será guardado.")
+    
+    # Actualizaciones de perfil en curso: corren en un hilo mientras continúa la conversación
+    pending_writes: set = set()
+    
+    async def update_profile(changes):
+        """Actualiza el perfil del usuario en la base de datos"""
+        try:
+            await _sb(supabase.table("user_profiles").update(changes)
+                .eq("identifier", profile_identifier)
+                .execute)
+        except Exception as e:
+            print(f"⚠️ Error al actualizar perfil: {str(e)}")
+    
+    async def flush_history():
+        """Espera a que se guarden los turnos pendientes, detiene el escritor y cierra el pool"""
+        nonlocal writer_task, db_pool
+        if pending_writes:
+            await asyncio.gather(*pending_writes, return_exceptions=True)
+        if writer_task is not None:
+            await history_queue.put(None)
+            await history_queue.join()
+            writer_task.cancel()
+            # Una segunda llamada (el finally del ciclo) ya no encola ni espera nada
+            writer_task = None
+        if db_pool:
+            await db_pool.close()
+            db_pool = None
+    
+    # Ciclo principal de conversación; al salir por cualquier vía (comando, Ctrl+C, EOF o error)
+    # se guardan los turnos pendientes y se cierra el pool de Postgres
+    try:
+        while True:
+            # Obtenemos el mensaje del usuario con prompt contextual
+            prompt = "¿Cómo puedo ayudarle hoy? " if not (session_context or conversation_history) else "¿En qué más puedo asistirle? "
+            # input() corre en un hilo para que el escritor del historial siga trabajando mientras tanto;
+            # fin de entrada (EOF) o Ctrl+C durante la lectura terminan la conversación como 'salir'
+            try:
+                message = await _read_line(prompt)
+            except (EOFError, KeyboardInterrupt):
+                print()
+                message = "salir"
+            # Normalizar una sola vez: se reutiliza para los comandos de salida y la opción elegida
+            message_lower = message.strip().casefold()
             
-            # Actualizamos el contexto de slots disponibles si se llamó a get_slots
-            tool_calls = [item for item in result.new_items 
-                         if hasattr(item, 'tool_call') and item.tool_call]
+            # Verificamos si el usuario quiere salir
+            if message_lower in _EXIT_COMMANDS:
+                # Guardar resumen final de la conversación si supabase está disponible
+                if supabase:
+                    try:
+                        end_time = datetime.now(timezone.utc).isoformat()
+                        
+                        # Sin una conversación real (menos de 4 elementos) no se paga la llamada al modelo
+                        if len(conversation_history) >= 4:
+                            # Crear un resumen de la conversación con el propio agente
+                            summary_input = [
+                                {"role": "system", "content": "Resume brevemente esta conversación en una sola frase."},
+                                *list(conversation_history)[-10:]  # Usamos los últimos 10 mensajes para el resumen
+                            ]
+                            
+                            summary_result = await Runner.run(agent, summary_input)
+                            conversation_summary = summary_result.final_output
+                        else:
+                            conversation_summary = "(sin conversación)"
+                        
+                        # Guardar el resumen
+                        await _sb(supabase.table("conversation_summaries").insert({
+                            "conversation_id": conversation_id,
+                            "user_identifier": user_id,
+                            "start_time": conversation_start_time,
+                            "end_time": end_time,
+                            "summary": conversation_summary,
+                            "message_count": turn_count
+                        }).execute)
+                    except Exception as e:
+                        print(f"⚠️ Error al guardar resumen: {str(e)}")
+                
+                # Guardar los turnos pendientes antes de terminar
+                await flush_history()
+                
+                print("¡Gracias por contactarnos! Esperamos darle la bienvenida pronto a nuestras experiencias. ¡Buen viaje!")
+                break
             
-            for item in tool_calls:
-                if item.tool_call.name == "get_slots" and hasattr(item, 'tool_result'):
-                    tool_result = item.tool_result
+            try:
+                # Entrada acotada: contexto fijo, resumen de lo antiguo, historial reciente,
+                # bloque dinámico de slots y el mensaje (de lo más estable a lo más cambiante)
+                run_input = [*session_context]
+                if rolling_summary:
+                    run_input.append({"role": "system", "content": f"Resumen de la conversación anterior: {rolling_summary}"})
+                run_input.extend(conversation_history)
+                if slots_context:
+                    run_input.append(slots_context)
+                prefix_length = len(run_input)
+                run_input.append({"role": "user", "content": message})
+                
+                # Ejecutamos el agente con el mensaje apropiado
+                result = await Runner.run(agent, run_input)
+                turn_count += 1
+                
+                # Extraer datos potencialmente persistentes del mensaje del usuario
+                # Esto permite actualizar automáticamente información del usuario que no cambia frecuentemente
+                detected_user_data = {}
+                # Prefiltro barato: los patrones solo pueden coincidir si aparece alguna de estas pistas
+                # (respuestas como "sí" o "mañana" no pasan por las tres regex)
+                if ("@" in message_lower or "llamo" in message_lower or "soy" in message_lower
+                        or "nombre" in message_lower or any(c.isdigit() for c in message_lower)):
+                    for key, pattern in _USER_DATA_PATTERNS:
+                        match = pattern.search(message)
+                        if match and key == "name":
+                            detected_user_data[key] = match.group(1).strip()
+                        elif match:
+                            detected_user_data[key] = match.group(0)
+                
+                # Actualizar la información del usuario en caché y potencialmente en BD,
+                # solo con los campos que realmente cambiaron (repetir el nombre no escribe nada)
+                changed_user_data = {
+                    key: value for key, value in detected_user_data.items()
+                    if user_profile.get(key) != value
+                }
+                if changed_user_data and supabase and profile_identifier:
+                    user_profile.update(changed_user_data)
+                    # Sin esperar: la respuesta se muestra mientras se escribe el perfil
+                    profile_task = asyncio.create_task(update_profile(changed_user_data))
+                    pending_writes.add(profile_task)
+                    profile_task.add_done_callback(pending_writes.discard)
+                
+                # Actualizamos el contexto de slots disponibles si se llamó a get_slots
+                # (una sola pasada; basta con el primer resultado válido)
+                for item in result.new_items:
+                    tool_call = getattr(item, 'tool_call', None)
+                    if not tool_call or tool_call.name != "get_slots":
+                        continue
+                    tool_result = getattr(item, 'tool_result', None)
                     if isinstance(tool_result, dict) and 'available_slots' in tool_result:
                         available_slots_data = tool_result['available_slots']
                         
                         # Detectar selección de opción por número en el mensaje del usuario
-                        option_match = re.search(r'\bopci[oó]n\s+(\d+)\b|\b(\d+)\b', message.lower())
-                        if option_match:
-                            option_num = int(option_match.group(1) or option_match.group(2))
-                            if 1 <= option_num <= len(available_slots_data):
-                                selected_slot = available_slots_data[option_num-1]
-            
-            # Mostramos la respuesta del agente
-            print(result.final_output)
-            
-            # Guardar el turno de conversación en la base de datos
-            await save_conversation_turn(message, result.final_output)
-            
-            # Actualizamos el historial de conversación para la próxima interacción
-            conversation_history = result.to_input_list()
-            
-            # Añadimos información sobre los slots disponibles para la siguiente interacción
-            if available_slots_data:
-                # Extraemos solo la fecha y hora para simplificar usando list comprehension
-                simple_slots = [
-                    {"date": slot["date"], "time": slot["start_time"]} 
-                    for slot in available_slots_data[:9]  # Limitamos a 9 slots
-                ]
+                        # Camino rápido para la respuesta habitual, que es solo el número
+                        if message_lower.isdigit():
+                            option_num = int(message_lower)
+                        elif (option_match := _RE_OPTION.search(message_lower)):
+                            option_num = int(option_match.group(1))
+                        else:
+                            option_num = None
+                        if option_num is not None and 1 <= option_num <= len(available_slots_data):
+                            selected_slot = available_slots_data[option_num-1]
+                        break
                 
-                # Añadimos esta información al contexto del sistema
-                context_message = f"Disponibilidades actuales: {simple_slots}"
-                conversation_history.append({"role": "system", "content": context_message})
+                # Mostramos la respuesta del agente
+                print(result.final_output)
                 
-        except Exception as e:
-            error_message = f"Lo siento, hemos encontrado un error inesperado: {str(e)}"
-            print(error_message)
-            
-            # En desarrollo podemos mostrar el traceback completo
-            import traceback
-            traceback.print_exc()
-            
-            # Añadir mensaje de error al contexto para que el agente pueda responder adecuadamente
-            conversation_history.append({"role": "system", "content": f"Error: {error_message}"})
-            continue
+                # Guardar el turno de conversación en la base de datos
+                await save_conversation_turn(message, result.final_output)
+                
+                # Actualizamos el historial con lo nuevo de este turno (mensaje del usuario incluido)
+                _append_history(conversation_history, islice(result.to_input_list(), prefix_length, None), evicted_items)
+                
+                # Resumir lo que salió del historial cuando se acumulan suficientes elementos
+                if len(evicted_items) >= SUMMARY_EVERY:
+                    try:
+                        summary_result = await Runner.run(agent, [
+                            {"role": "system", "content": "Resume brevemente esta parte de la conversación en pocas frases, conservando los datos importantes."},
+                            *([{"role": "system", "content": f"Resumen previo: {rolling_summary}"}] if rolling_summary else []),
+                            # Solo mensajes: llamadas a herramientas o razonamientos sueltos no son entradas válidas
+                            *(item for item in evicted_items if isinstance(item, dict) and "role" in item)
+                        ])
+                        rolling_summary = summary_result.final_output
+                    except Exception as e:
+                        print(f"⚠️ Error al resumir el historial: {str(e)}")
+                    evicted_items.clear()
+                
+                # Añadimos información sobre los slots disponibles para la siguiente interacción
+                if available_slots_data:
+                    # Extraemos solo la fecha y hora en un texto compacto y determinista
+                    simple_slots = "; ".join(
+                        f"{day} {start}"
+                        for day, start in map(_slot_date_time, available_slots_data[:9])  # Limitamos a 9 slots
+                    )
+                    
+                    # Añadimos esta información al bloque dinámico del siguiente turno
+                    slots_context = {"role": "system", "content": f"Disponibilidades actuales: {simple_slots}"}
+                    
+            except Exception as e:
+                error_message = f"Lo siento, hemos encontrado un error inesperado: {str(e)}"
+                print(error_message)
+                
+                # En desarrollo podemos mostrar el traceback completo
+                if _SHOW_TRACEBACKS:
+                    traceback.print_exc()
+                
+                # Añadir mensaje de error al contexto para que el agente pueda responder adecuadamente
+                _append_history(conversation_history, [{"role": "system", "content": f"Error: {error_message}"}], evicted_items)
+                continue
+    finally:
+        await flush_history()
+
+async def run() -> None:
+    """Ejecuta la conversación y cierra la sesión HTTP compartida al terminar."""
+    try:
+        await main()
+    finally:
+        await close_session()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(run())
\ No newline at end of file
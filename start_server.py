@@ -13,7 +13,7 @@ Facilita el arranque del servidor en diferentes entornos.
 
 import os
 import sys
-import subprocess
+import shutil
 import logging
 from dotenv import load_dotenv
 
@@ -29,10 +29,8 @@ def main():
     # Cargar variables de entorno
     load_dotenv()
     
-    # Verificar que Gunicorn está instalado
-    try:
-        import gunicorn
-    except ImportError:
+    # Verificar que Gunicorn está instalado (sin importar el paquete)
+    if shutil.which("gunicorn") is None:
         logger.error("Gunicorn no está instalado. Por favor, instala las dependencias con 'pip install -r requirements.txt'")
         sys.exit(1)
     
@@ -41,13 +39,8 @@ def main():
         logger.error("El archivo de configuración de Gunicorn no existe. Asegúrate de que estás en el directorio correcto.")
         sys.exit(1)
     
-    # Verificar que la aplicación existe
-    try:
-        from app.main import app
-        logger.info("Aplicación cargada correctamente")
-    except ImportError:
-        logger.error("No se pudo cargar la aplicación. Verifica la estructura del proyecto.")
-        sys.exit(1)
+    # La aplicación no se importa aquí: los workers de Gunicorn ya la cargan (y fallan
+    # al arrancar si no existe), así que importarla antes solo duplicaba la inicialización
     
     # Obtener valores de configuración
     port = os.getenv("WEBHOOK_PORT", "8000")
@@ -75,13 +68,15 @@ def main():
         "app.main:app"
     ]
     
-    # Ejecutar Gunicorn
+    # Ejecutar Gunicorn reemplazando este proceso: no queda un padre Python residente
+    # y las señales (SIGTERM de docker/systemd) llegan directamente al master de Gunicorn
+    logger.info("Iniciando Gunicorn...")
     try:
-        logger.info("Iniciando Gunicorn...")
-        subprocess.run(cmd)
-    except KeyboardInterrupt:
-        logger.info("Servidor detenido manualmente")
-    except Exception as e:
+        os.execvp(cmd[0], cmd)  # No retorna si tiene éxito
+    except FileNotFoundError:
+        logger.error("No se encontró el ejecutable de Gunicorn en el PATH")
+        sys.exit(1)
+    except OSError as e:
         logger.error(f"Error al iniciar el servidor: {str(e)}")
         sys.exit(1)
 
@@ -5,71 +5,62 @@ Esto es útil para mantener la compatibilidad mientras se migra a una estructura
 import os
 import sys
 
+if os.name == 'nt':
+    import _winapi
+
+# Enlaces a crear como (origen, destino), relativos al directorio base
+_LINKS = (
+    # Enlaces para configuración
+    (('app', 'infrastructure', 'config', 'config'), ('app', 'config')),
+    # Enlaces para modelos
+    (('app', 'domain', 'entities', 'models'), ('app', 'models')),
+    # Enlaces para webhook
+    (('app', 'presentation', 'webhook'), ('app', 'webhook')),
+    # Enlaces para tools
+    (('app', 'application', 'services', 'tools'), ('app', 'tools')),
+    # Enlaces para agents
+    (('app', 'infrastructure', 'external', 'agents'), ('app', 'agents')),
+    # Enlaces para services
+    (('app', 'infrastructure', 'persistence'), ('app', 'services')),
+)
+
 def create_symlink(source, target):
-    """Crear un enlace simbólico de source a target."""
+    """Crear un enlace simbólico de source a target (el directorio padre debe existir)."""
+    # Se intenta crear directamente (EAFP): sin comprobación previa no hay carrera entre
+    # comprobar y crear, y un destino existente se detecta por FileExistsError
     try:
-        # En Windows los enlaces simbólicos requieren privilegios especiales o modo desarrollador
+        # En Windows los enlaces simbólicos requieren privilegios especiales o modo desarrollador,
+        # así que se crea una unión de directorios directamente con la API de Win32 (sin shell)
         if os.name == 'nt':  # Windows
-            if not os.path.exists(target):
-                os.makedirs(os.path.dirname(target), exist_ok=True)
-                os.system(f'mklink /J "{target}" "{source}"')
-                print(f"Enlace creado: {source} -> {target}")
-            else:
-                print(f"El destino ya existe: {target}")
+            _winapi.CreateJunction(source, target)
         else:  # Unix/Linux/MacOS
-            if not os.path.exists(target):
-                os.makedirs(os.path.dirname(target), exist_ok=True)
-                os.symlink(source, target, target_is_directory=True)
-                print(f"Enlace creado: {source} -> {target}")
-            else:
-                print(f"El destino ya existe: {target}")
-    except Exception as e:
+            os.symlink(source, target, target_is_directory=True)
+        print(f"Enlace creado: {source} -> {target}")
+    except FileExistsError:
+        print(f"El destino ya existe: {target}")
+    except OSError as e:
         print(f"Error al crear enlace {source} -> {target}: {str(e)}")
 
 def main():
     """Crear los enlaces simbólicos necesarios."""
     print("Creando enlaces simbólicos para la configuración...")
-    
+
     # Directorios base
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Enlaces para configuración
-    create_symlink(
-        os.path.join(base_dir, 'app', 'infrastructure', 'config', 'config'),
-        os.path.join(base_dir, 'app', 'config')
-    )
-    
-    # Enlaces para modelos
-    create_symlink(
-        os.path.join(base_dir, 'app', 'domain', 'entities', 'models'),
-        os.path.join(base_dir, 'app', 'models')
-    )
-    
-    # Enlaces para webhook
-    create_symlink(
-        os.path.join(base_dir, 'app', 'presentation', 'webhook'),
-        os.path.join(base_dir, 'app', 'webhook')
-    )
-    
-    # Enlaces para tools
-    create_symlink(
-        os.path.join(base_dir, 'app', 'application', 'services', 'tools'),
-        os.path.join(base_dir, 'app', 'tools')
-    )
-    
-    # Enlaces para agents
-    create_symlink(
-        os.path.join(base_dir, 'app', 'infrastructure', 'external', 'agents'),
-        os.path.join(base_dir, 'app', 'agents')
-    )
-    
-    # Enlaces para services
-    create_symlink(
-        os.path.join(base_dir, 'app', 'infrastructure', 'persistence'),
-        os.path.join(base_dir, 'app', 'services')
-    )
-    
+
+    links = [
+        (os.path.join(base_dir, *source), os.path.join(base_dir, *target))
+        for source, target in _LINKS
+    ]
+
+    # Crear cada directorio padre una sola vez
+    for parent in {os.path.dirname(target) for _, target in links}:
+        os.makedirs(parent, exist_ok=True)
+
+    for source, target in links:
+        create_symlink(source, target)
+
     print("Proceso completado.")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()